@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the counting pipeline of count_loc.py.
+
+Generates a synthetic git repository locally (no network) with a
+configurable number of files, lines and commits, including merge commits,
+and runs `count_loc.process_repository` on it end to end in every counting
+mode. Reports commits per second, the seconds per commit spent checking out
+and counting, and the peak RSS of the process and of its children (git,
+cloc) as a table and as JSON, so results can be compared between changes.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import resource
+import platform
+import tempfile
+import contextlib
+import multiprocessing
+from datetime import datetime
+
+import count_loc
+
+
+BENCH_dir = "./results/bench"
+
+# Size of the generated repository
+NUM_commits = 200
+NUM_files = 200
+FILE_lines = 200
+# Every N-th commit on the main branch merges a topic branch (0: no merges)
+MERGE_every = 5
+RANDOM_seed = 42
+NUM_repeat = 1
+
+# Counting modes: name -> options of the repository (see `git_repositories`)
+BENCH_modes = {
+    "checkout": {},
+    "incremental": {"incremental": True},
+    "no-checkout": {"no_checkout": True},
+    "python": {"no_checkout": True, "counter": "python"},
+}
+# Modes that do not need cloc
+CLOC_free_modes = ["python"]
+
+# Comment syntax of the generated files: extension -> line comment marker
+FILE_types = {".cpp": "//", ".hpp": "//", ".cu": "//", ".c": "//", ".h": "//",
+              ".py": "#", ".cmake": "#"}
+
+
+def generate_line(rng, comment):
+    choice = rng.random()
+    if choice < 0.15:
+        return ""
+    if choice < 0.35:
+        return "{} comment {}".format(comment, rng.randrange(10**6))
+    return "    value_{} = value_{} + {};".format(rng.randrange(1000), rng.randrange(1000),
+                                                  rng.randrange(10**6))
+
+
+def generate_file(rng, path, num_lines):
+    comment = FILE_types[os.path.splitext(path)[1]]
+    return [generate_line(rng, comment) for _ in range(num_lines)]
+
+
+def modify_file(rng, path, lines):
+    """Replaces, inserts and deletes a few random lines of `lines`."""
+    comment = FILE_types[os.path.splitext(path)[1]]
+    for _ in range(rng.randint(1, 10)):
+        action = rng.random()
+        pos = rng.randrange(len(lines) + 1)
+        if action < 0.5 or not lines:
+            lines.insert(pos, generate_line(rng, comment))
+        elif action < 0.8:
+            lines[min(pos, len(lines) - 1)] = generate_line(rng, comment)
+        else:
+            del lines[min(pos, len(lines) - 1)]
+
+
+def commit_command(ref, mark, timestamp, parent, merge, files, changed):
+    """Returns the fast-import command of one commit that writes all paths in
+    `changed` with their content in `files`."""
+    message = "Commit {}\n".format(mark).encode()
+    cmd = [("commit {}\nmark :{}\n".format(ref, mark)
+            + "author Bench <bench@example.com> {} +0000\n".format(timestamp)
+            + "committer Bench <bench@example.com> {} +0000\n".format(timestamp)
+            + "data {}\n".format(len(message))).encode() + message]
+    if parent is not None:
+        cmd.append("from :{}\n".format(parent).encode())
+    if merge is not None:
+        cmd.append("merge :{}\n".format(merge).encode())
+    for path in sorted(changed):
+        data = ('\n'.join(files[path]) + '\n').encode()
+        cmd.append("M 100644 inline {}\ndata {}\n".format(path, len(data)).encode() + data)
+    cmd.append(b"\n")
+    return b"".join(cmd)
+
+
+def generate_repository(path, num_commits, num_files, file_lines, merge_every, seed):
+    """Creates the bare repository `path` with `num_commits` commits on its
+    `main` branch, one per day. The first commit adds half of the
+    `num_files` files, later commits modify a few files and add the others.
+    Every `merge_every`-th commit merges a topic branch of two commits."""
+    rng = random.Random(seed)
+    count_loc.run_cmd([count_loc.GIT_binary, "init", "--quiet", "--bare", path])
+    count_loc.run_cmd([count_loc.GIT_binary, "symbolic-ref", "HEAD", "refs/heads/main"], cwd=path)
+    extensions = sorted(FILE_types)
+    files = {}
+    next_file = [0]
+
+    def add_file():
+        name = "src/dir{}/file{}{}".format(next_file[0] % 10, next_file[0],
+                                          extensions[next_file[0] % len(extensions)])
+        next_file[0] += 1
+        files[name] = generate_file(rng, name, file_lines)
+        return name
+
+    def change_files():
+        changed = set()
+        for _ in range(rng.randint(1, 3)):
+            name = rng.choice(sorted(files))
+            modify_file(rng, name, files[name])
+            changed.add(name)
+        if next_file[0] < num_files and rng.random() < 0.5:
+            changed.add(add_file())
+        return changed
+
+    stream = []
+    timestamp = 1420070400 # 2015-01-01
+    mark = 1
+    stream.append(commit_command("refs/heads/main", mark, timestamp, None, None, files,
+                                 [add_file() for _ in range(max(1, num_files // 2))]))
+    main_mark = mark
+    for i in range(1, num_commits):
+        timestamp += 24 * 60 * 60
+        if merge_every and i % merge_every == 0:
+            # Topic branch of two commits, merged with --no-ff
+            topic_mark = main_mark
+            topic_changed = set()
+            for j in range(2):
+                mark += 1
+                changed = change_files()
+                topic_changed |= changed
+                stream.append(commit_command("refs/heads/topic", mark, timestamp - 3600 * (2 - j),
+                                             topic_mark, None, files, changed))
+                topic_mark = mark
+            mark += 1
+            stream.append(commit_command("refs/heads/main", mark, timestamp, main_mark, topic_mark,
+                                         files, topic_changed))
+        else:
+            mark += 1
+            stream.append(commit_command("refs/heads/main", mark, timestamp, main_mark, None,
+                                         files, change_files()))
+        main_mark = mark
+    count_loc.run_cmd([count_loc.GIT_binary, "fast-import", "--quiet"], cwd=path,
+                      input=b"".join(stream))
+    count_loc.run_cmd([count_loc.GIT_binary, "branch", "-D", "topic"], True, cwd=path)
+    return mark
+
+
+def run_mode(args):
+    """Counts the benchmark repository in one mode (inside a fresh worker
+    process, so the peak RSS belongs to this mode only). Returns the
+    measurements."""
+    mode, idict, bench_root = args
+    mode_dir = os.path.join(bench_root, mode)
+    shutil.rmtree(mode_dir, True)
+    count_loc.OUT_dir = os.path.join(mode_dir, "results")
+    count_loc.OUT_dir_tmp = os.path.join(count_loc.OUT_dir, "tmp")
+    count_loc.STORE_dir = os.path.join(count_loc.OUT_dir, "store")
+    count_loc.BLOB_cache_file = os.path.join(count_loc.OUT_dir, "blob_cache.sqlite")
+    work_dir = os.path.join(mode_dir, "work")
+    for directory in (count_loc.OUT_dir_tmp, work_dir):
+        os.makedirs(directory)
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        begin = time.time()
+        count_loc.process_repository("bench", idict, work_dir)
+        seconds = time.time() - begin
+    totals = count_loc.LATENCY_totals
+    commits = max(1, totals["commits"])
+    # ru_maxrss is in KiB on Linux
+    return {
+        "mode": mode,
+        "commits": totals["commits"],
+        "seconds": seconds,
+        "commits_per_second": totals["commits"] / seconds,
+        "checkout_seconds_per_commit": totals["checkout"] / commits,
+        "count_seconds_per_commit": totals["count"] / commits,
+        "other_seconds": seconds - totals["checkout"] - totals["count"],
+        "peak_rss_mib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "peak_rss_children_mib": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        }
+
+
+def run_benchmark(modes):
+    """Generates the repository and runs all `modes` `NUM_repeat` times.
+    Returns the benchmark report (see the module description)."""
+    bench_root = tempfile.mkdtemp(prefix="loc_bench_", dir=count_loc.TMP_storage)
+    try:
+        source = os.path.join(bench_root, "source.git")
+        begin = time.time()
+        num_commits = generate_repository(source, NUM_commits, NUM_files, FILE_lines,
+                                          MERGE_every, RANDOM_seed)
+        generate_seconds = time.time() - begin
+        cloc_found = shutil.which(count_loc.CLOC_binary) is not None
+        if cloc_found:
+            count_loc.CLOC_version = count_loc.run_cmd([count_loc.CLOC_binary, "--version"]).output[0]
+
+        results = []
+        for mode in modes:
+            if not cloc_found and mode not in CLOC_free_modes:
+                results.append({"mode": mode, "skipped": "cloc not found"})
+                continue
+            idict = dict(BENCH_modes[mode], url=source, all_commits=True, langs="ALL")
+            runs = []
+            for _ in range(NUM_repeat):
+                # A new process per run, so the RSS and totals start fresh
+                with multiprocessing.get_context("fork").Pool(1) as pool:
+                    runs.append(pool.apply(run_mode, [(mode, idict, bench_root)]))
+            best = dict(min(runs, key=lambda run: run["seconds"]))
+            best["runs_seconds"] = [run["seconds"] for run in runs]
+            results.append(best)
+    finally:
+        shutil.rmtree(bench_root, True)
+
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "repository": {"commits": num_commits, "main_commits": NUM_commits, "files": NUM_files,
+                       "file_lines": FILE_lines, "merge_every": MERGE_every, "seed": RANDOM_seed,
+                       "generate_seconds": generate_seconds},
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "cpus": os.cpu_count(),
+                        "git": count_loc.run_cmd([count_loc.GIT_binary, "--version"]).output[0],
+                        "cloc": count_loc.CLOC_version},
+        "repeat": NUM_repeat,
+        "results": results,
+        }
+
+
+def print_table(report):
+    print("{:<12} {:>8} {:>9} {:>10} {:>14} {:>12} {:>9} {:>14}".format(
+        "mode", "commits", "seconds", "commits/s", "checkout s/c", "count s/c", "RSS MiB",
+        "child RSS MiB"))
+    for result in report["results"]:
+        if "skipped" in result:
+            print("{:<12} skipped: {}".format(result["mode"], result["skipped"]))
+            continue
+        print("{:<12} {:>8} {:>9.2f} {:>10.2f} {:>14.4f} {:>12.4f} {:>9.1f} {:>14.1f}".format(
+            result["mode"], result["commits"], result["seconds"], result["commits_per_second"],
+            result["checkout_seconds_per_commit"], result["count_seconds_per_commit"],
+            result["peak_rss_mib"], result["peak_rss_children_mib"]))
+
+
+def print_help():
+    print("Usage: {} [options]\n".format(sys.argv[0])
+        + "Options and arguments:\n"
+        + "-h, --help:      Print this help\n"
+        + "--commits N:     Commits on the main branch (default: {})\n".format(NUM_commits)
+        + "--files N:       Files in the final commit (default: {})\n".format(NUM_files)
+        + "--lines N:       Lines of every new file (default: {})\n".format(FILE_lines)
+        + "--merge-every N: Merge a topic branch every N commits, 0 for a\n"
+        + "                 linear history (default: {})\n".format(MERGE_every)
+        + "--seed N:        Seed of the generated content (default: {})\n".format(RANDOM_seed)
+        + "--repeat N:      Run every mode N times and report the fastest\n"
+        + "                 run (default: {})\n".format(NUM_repeat)
+        + "--modes M:       Comma separated list of the modes to run out of\n"
+        + "                 {} (default: all)\n".format(", ".join(BENCH_modes))
+        + "--output PATH:   Write the JSON report to PATH (default: a new file\n"
+        + "                 in {})".format(BENCH_dir)
+         )
+
+
+def parse_args(argv):
+    """Parses the command line options and overwrites the corresponding
+    globals. Returns the tuple (modes, output path or None). Exits with a
+    help message on invalid input."""
+    global NUM_commits, NUM_files, FILE_lines, MERGE_every, RANDOM_seed, NUM_repeat
+    modes = list(BENCH_modes)
+    output = None
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        has_number = i + 1 < len(argv) and argv[i + 1].isdigit()
+        if arg == "-h" or arg == "--help":
+            print_help()
+            exit(0)
+        elif arg == "--commits" and has_number:
+            NUM_commits = max(1, int(argv[i + 1]))
+            i += 1
+        elif arg == "--files" and has_number:
+            NUM_files = max(1, int(argv[i + 1]))
+            i += 1
+        elif arg == "--lines" and has_number:
+            FILE_lines = max(1, int(argv[i + 1]))
+            i += 1
+        elif arg == "--merge-every" and has_number:
+            MERGE_every = int(argv[i + 1])
+            i += 1
+        elif arg == "--seed" and has_number:
+            RANDOM_seed = int(argv[i + 1])
+            i += 1
+        elif arg == "--repeat" and has_number:
+            NUM_repeat = max(1, int(argv[i + 1]))
+            i += 1
+        elif (arg == "--modes" and i + 1 < len(argv)
+              and set(argv[i + 1].split(',')) <= set(BENCH_modes)):
+            modes = argv[i + 1].split(',')
+            i += 1
+        elif arg == "--output" and i + 1 < len(argv):
+            output = os.path.abspath(argv[i + 1])
+            i += 1
+        else:
+            print_help()
+            exit(1)
+        i += 1
+    return modes, output
+
+
+if __name__ == "__main__":
+    modes, output = parse_args(sys.argv[1:])
+
+    # Change to the directory where the script is placed
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    count_loc.PRINT_DEBUG = False
+    if not os.path.exists(count_loc.TMP_storage):
+        os.makedirs(count_loc.TMP_storage)
+
+    report = run_benchmark(modes)
+    print_table(report)
+    if output is None:
+        if not os.path.exists(BENCH_dir):
+            os.makedirs(BENCH_dir)
+        output = os.path.join(BENCH_dir, "bench_{}.json".format(datetime.now().strftime("%Y%m%d_%H%M%S")))
+    with open(output, 'w') as output_file:
+        json.dump(report, output_file, indent=4)
+        output_file.write('\n')
+    print("Report written to {}".format(output))
@@ -1,15 +1,49 @@
 #!/usr/bin/env python3
 
 import os
+import sys
 import subprocess
 import shutil
-from datetime import datetime, timezone
+import multiprocessing
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import time
+import tempfile
+import sqlite3
+import hashlib
+import json
+import heapq
+import cProfile
+import fcntl
+
+import line_counter
+import loc_storage
 
 
 TMP_storage = "/tmp/loc_count"
+# Clone repositories into this RAM-backed (tmpfs) directory instead of
+# TMP_storage if their estimated size fits (`--ram-scratch PATH`, e.g.
+# /dev/shm/loc_count). The size is estimated from the mirror or from the
+# previous run, so repositories without either always start on disk.
+# Every run works in its own subdirectory RAM_scratch_root, which is the only
+# thing it removes again.
+RAM_scratch_dir = None
+RAM_scratch_root = None
+# Maximum bytes used on the file system of RAM_scratch_dir, including other
+# users (`--ram-budget MB`, None: only limited by its free space)
+RAM_scratch_budget = None
+# Bytes that are always left free on the scratch file systems; a repository
+# whose estimated size does not fit fails before it is cloned
+SCRATCH_reserve = 1 << 30
+# Safety factor on the estimated size, since older commits can be larger
+SCRATCH_factor = 1.5
 OUT_dir = "./results"
 OUT_dir_tmp = "./results/tmp"
+# Columnar store of the results and per-language tables of every commit,
+# including the index of all repositories (see loc_storage.py). The CSV files
+# in OUT_dir are exported from it.
+STORE_dir = "./results/store"
 
 # Internal delimiters (never seen in output)
 CSV_delim = "," # In cloc-version 1.9, only ',' works properly as a delimiter
@@ -21,6 +55,103 @@ CLOC_binary = "cloc"
 GIT_binary = "git"
 PRINT_DEBUG = True
 
+# JSON file with the repositories to process: name -> options (see
+# `git_repositories`), processed in the order of the file unless there are
+# timings of previous runs (`--config PATH`)
+CONFIG_file = "./repositories.json"
+# Wall-clock budget of a run in seconds (`--time-budget MINUTES`).
+# Repositories that are not expected to fit are deferred to a later run, and
+# no repository is started after RUN_deadline.
+TIME_budget = None
+RUN_deadline = None
+# Names of the only repositories to process (`--only NAMES`), or None for all
+ONLY_repositories = None
+
+# Number of repositories that are cloned and counted concurrently
+# (can be changed with `--jobs N`)
+NUM_jobs = 1
+# Number of repositories that are cloned or fetched ahead of counting, while
+# others are counted; enables the pipelined (asyncio) orchestration
+# (`--prefetch N`)
+NUM_prefetch = 0
+# Number of clones or fetches running concurrently in the pipelined
+# orchestration; NUM_jobs repositories are counted concurrently
+# (`--fetch-jobs N`)
+NUM_fetch_jobs = 2
+# Number of git worktrees the commits of a single repository are split into
+# (can be changed with `--shards N` or per repository with "shards": N)
+NUM_shards = 1
+# Only count the files that changed between two consecutive commits instead
+# of the full tree (can be changed with `--incremental` or per repository
+# with "incremental": True)
+USE_incremental = False
+# Count straight from the git object database without ever checking out a
+# commit; implies the incremental counting (`--no-checkout` or per repository
+# "no_checkout": True)
+NO_checkout = False
+# Clone without blobs (`--filter=blob:none`) when no checkout is needed, so
+# only the blobs that are actually counted are downloaded (`--blobless` or
+# per repository "blobless": True)
+USE_blobless = False
+# Persistent cache of the line counts of every blob, shared by all
+# repositories and runs; implies the incremental counting (`--blob-cache`)
+USE_blob_cache = False
+BLOB_cache_file = OUT_dir + "/blob_cache.sqlite"
+# Maximum number of cached blobs, the least recently used ones are evicted
+BLOB_cache_max_entries = 20000000
+
+# Directory of persistent bare mirrors of all repositories, which are only
+# fetched on reruns instead of being cloned again (`--mirror-dir PATH`).
+# If not set, every repository is cloned from scratch and deleted afterwards.
+MIRROR_dir = None
+# Optional repository whose object store new mirrors borrow objects from
+# (`git clone --reference-if-able`, `--reference PATH`)
+REFERENCE_repo = None
+
+# Only read the history added since the tip recorded by the previous run
+# (`<tip>..<branch>`) instead of walking back to the newest counted commit
+# (disable with `--full-history`)
+USE_last_tip = True
+
+# Default budget of counted commits per repository (None: no budget)
+NUM_samples = None
+MIN_merge_commits = 100
+# Tool used to count the lines: "cloc" or "python", which uses the
+# in-process counter of line_counter.py instead of starting cloc for every
+# commit; "python" implies the incremental counting (`--counter TOOL` or per
+# repository "counter": TOOL)
+COUNT_tool = "cloc"
+
+# Set from `cloc --version` at startup; part of the blob cache key
+CLOC_version = ""
+
+# Number of counted commits and the total seconds spent checking them out and
+# counting them in this process (read by bench_loc.py)
+LATENCY_totals = {"commits": 0, "checkout": 0.0, "count": 0.0}
+LATENCY_lock = threading.Lock()
+
+# Per-stage timing: every command, counted commit and repository is appended
+# as one JSON line to TRACE_file (`--trace PATH`) and summarized at the end
+TRACE_file = None
+TRACE_lock = threading.Lock()
+TRACE_fd = None
+TRACE_pid = None
+# Repository processed by this process, and commit processed by each thread
+TRACE_repo = None
+TRACE_context = threading.local()
+# If set (`--profile DIR`), the Python side of every repository is profiled
+# with cProfile into DIR/<name>.prof
+PROFILE_dir = None
+
+# Progress of the whole run, e.g. for a dashboard to poll (`--status PATH`).
+# Every repository writes its own state to OUT_dir_tmp/status/<name>.json,
+# which are merged into STATUS_file.
+STATUS_file = OUT_dir + "/status.json"
+# Minimum number of seconds between two status updates while counting
+STATUS_interval = 5.0
+# Number of recently counted commits the per-commit cost is averaged over
+PROGRESS_window = 20
+
 
 default_languages = [
         "C", "C++", "C/C++ Header", "CUDA",
@@ -39,126 +170,27 @@ default_languages = [
 
 
 # TODO
-# - Add automatic discovery when "--merges" does not work (less than 100?
-#   commits) and switch to interval usage (maybe evendetermine the interval
-#   automatically)
 # - Detection that something went wrong to clean out the TMP directory
 
 
+# Options of a repository in CONFIG_file:
 # If all languages of `cloc` should be considered, add the dictionary entry
 # "langs": "ALL"
 
-git_repositories = {
-    # Note: Running everything in this list takes more than 24 hrs (on Linux),
-    #       which is why it is recommended to comment out parts
-    #"delete_me": {"""
-    "Ghost": { "url": "https://bitbucket.org/essex/ghost.git", "day_interval": 15, "all_commits": True, },
-    "uBLAS": { "url": "https://github.com/boostorg/ublas.git", "day_interval": 15, "all_commits": True, },
-    "KBLAS-gpu": { "url": "https://github.com/ecrc/kblas-gpu.git", "all_commits": True, },
-    "KBLAS-cpu": { "url": "https://github.com/ecrc/kblas-cpu.git", "all_commits": True, },
-    "clBLAS": { "url": "https://github.com/clMathLibraries/clBLAS.git", "all_commits": True, },
-    "FLENS": { "url": "https://github.com/michael-lehn/FLENS.git", "all_commits": True, },
-    "SuiteSparse": { "url": "https://github.com/DrTimothyAldenDavis/SuiteSparse.git", "all_commits": True, },
-    "BootCMatch": { "url": "https://github.com/bootcmatch/BootCMatch.git", "all_commits": True, },
-    "AMGCL": { "url": "https://github.com/ddemidov/amgcl.git", "day_interval": 15, "all_commits": True, },
-    "DUNE-ISTL": { "url": "https://github.com/dune-project/dune-istl.git", },
-    "BLOPEX": { "url": "https://bitbucket.org/joseroman/blopex.git", "all_commits": True, },
-    "EVSL": { "url": "https://github.com/eigs/EVSL.git", "all_commits": True, },
-    "Spectra": { "url": "https://github.com/yixuan/spectra.git", "all_commits": True, },
-    "Dense_HODLR": { "url": "https://github.com/amiraa127/Dense_HODLR.git", "all_commits": True, },
-    "H2Lib": { "url": "https://github.com/H2Lib/H2Lib.git", "all_commits": True, },
-    "hmat-oss": { "url": "https://github.com/jeromerobert/hmat-oss.git", "all_commits": True, },
-    "STRUMPACK": { "url": "https://github.com/pghysels/STRUMPACK.git", "all_commits": True, },
-    "GetFEM": { "url": "https://git.savannah.nongnu.org/git/getfem.git", "day_interval": 60, "all_commits": True, },
-    #"Ginkgo_Container": { "url": "git@gitlab.com:ginkgo-project/ginkgo-containers.git" },
-    "Ginkgo": {
-        "url": "https://github.com/ginkgo-project/ginkgo.git",
-        "add_cloc_args": ["--force-lang=cuda,hpp.inc"],
-        #"langs": default_languages,
-        "branch": "develop",
-        },
-    "Kokkos": { "url": "https://github.com/kokkos/kokkos", "branch": "develop", },
-    "Kokkos Kernels": { "url": "https://github.com/kokkos/kokkos-kernels", "branch": "develop", },
-    "Heat": { "url": "https://github.com/helmholtz-analytics/heat.git", },
-    "Nest": { "url": "https://github.com/nest/nest-simulator.git", },
-    "fleur": { "url": "https://iffgit.fz-juelich.de/fleur/fleur.git", },
-    "LAMMPS": { "url": "https://github.com/lammps/lammps.git", "day_interval": 15, },
-    "Trilinos": { "url": "https://github.com/trilinos/Trilinos.git", "day_interval": 15, },
-    "MFEM": { "url": "https://github.com/mfem/mfem.git", },
-    "deal.II": { "url": "https://github.com/dealii/dealii.git", "day_interval": 15, },
-    "SuperLU": { "url": "https://github.com/xiaoyeli/superlu.git", "all_commits": True, },
-    "hypre": { "url": "https://github.com/hypre-space/hypre.git", },
-    "petsc": { "url": "https://gitlab.com/petsc/petsc.git", "day_interval": 15, },
-    "Slate": { "url": "https://bitbucket.org/icl/slate.git", },
-    "MAGMA": {"url": "https://bitbucket.org/icl/magma.git", },
-
-    "STXXL": { "url": "https://github.com/stxxl/stxxl.git", },
-    "Thrill": { "url": "https://github.com/thrill/thrill.git", },
-    "TLX": { "url": "https://github.com/tlx/tlx.git", },
-    "KaHIP": { "url": "https://github.com/schulzchristian/KaHIP.git", },
-    "KaHyPar": { "url": "https://github.com/SebastianSchlag/kahypar.git", },
-    "KaMIS": { "url": "https://github.com/sebalamm/KaMIS.git", "all_commits": True, },
-    "NetworKit": { "url": "https://github.com/networkit/networkit.git", },
-    "sdsl-lite": { "url": "https://github.com/simongog/sdsl-lite.git", },
-    #"TBTrader": { "url": "https://github.com/bingmann/tbtrader.git", },
-    "Glowing-Bear": { "url": "https://github.com/glowing-bear/glowing-bear.git", },
-    # Algebra
-    "LAPACK": { "url": "https://github.com/Reference-LAPACK/lapack.git", },
-    "OpenBLAS": { "url": "https://github.com/xianyi/OpenBLAS.git", "day_interval": 15, },
-    "ScaLAPACK": { "url": "https://github.com/Reference-ScaLAPACK/scalapack.git", "all_commits": True, },
-    "DBCSR": { "url": "https://github.com/cp2k/dbcsr.git", },
-    "Eigen": { "url": "https://gitlab.com/libeigen/eigen.git", "day_interval": 15, "all_commits": True, },
-    "Armadillo": { "url": "https://gitlab.com/conradsnicta/armadillo-code.git", "all_commits": True, },
-    "Elemental": { "url": "https://github.com/elemental/Elemental.git", },
-
-    # Graphs
-    "OGDF": { "url": "https://github.com/ogdf/ogdf.git", "all_commits": True, },
-    "GraphChi": { "url": "https://github.com/GraphChi/graphchi-cpp.git", },
-    "Ligra": { "url": "https://github.com/jshun/ligra.git", },
-    # Bio
-    "SeqAN": { "url": "https://github.com/seqan/seqan.git", },
-    "genesis": { "url": "https://github.com/lczech/genesis.git", },
-    "Treerecs": { "url": "https://gitlab.inria.fr/Phylophile/Treerecs.git", "all_commits": True, },
-    "RAxML-ng": { "url": "https://github.com/amkozlov/raxml-ng.git", },
-    # Solving
-    "CVC4": { "url": "https://github.com/CVC4/CVC4.git", },
-    "MiniSAT": { "url": "https://github.com/niklasso/minisat.git", },
-    # Etc
-    #"Parsec": { "url": "http://icl.utk.edu/parsec/", },
-    "Charm++": { "url": "https://github.com/UIUC-PPL/charm.git", },
-    "HPX": { "url": "https://github.com/STEllAR-GROUP/hpx.git", },
-    "osrm-backend": { "url": "https://github.com/Project-OSRM/osrm-backend.git", },
-    "CP2K": { "url": "https://github.com/cp2k/cp2k.git", "day_interval": 15, "all_commits": True, },
-    "root": { "url": "https://github.com/root-project/root.git", },
-    
-    # BIG projects
-    "Giraph": { "url": "https://github.com/apache/giraph.git", "all_commits": True, },
-    "NetworkX": { "url": "https://github.com/networkx/networkx.git", },
-    "PyTorch": { "url": "https://github.com/pytorch/pytorch.git", },
-    "mlpack": { "url": "https://github.com/mlpack/mlpack.git", },
-    "Z3": { "url": "https://github.com/Z3Prover/z3.git", },
-    "folly": { "url": "https://github.com/facebook/folly.git", "all_commits": True, },
-    "git": { "url": "https://github.com/git/git.git", "day_interval": 15, },
-    "Mesos": { "url": "https://github.com/apache/mesos.git", "day_interval": 15, "all_commits": True, },
-    "OpenMPI": { "url": "https://github.com/open-mpi/ompi.git", "day_interval": 15, },
-    "MPICH": { "url": "https://github.com/pmodels/mpich.git", },
-    "X10": { "url": "https://github.com/x10-lang/x10.git", "day_interval": 15, "all_commits": True, },
-    "Spark": { "url": "https://github.com/apache/spark.git", },
-    "Flink": { "url": "https://github.com/apache/flink.git", },
-    "Hadoop": { "url": "https://github.com/apache/hadoop.git", },
-    "Storm": { "url": "https://github.com/apache/storm.git", "day_interval": 15, },
-    "Tensorflow": { "url": "https://github.com/tensorflow/tensorflow.git", "day_interval": 15, },
-    "Arrow": { "url": "https://github.com/apache/arrow.git", "day_interval": 15, "all_commits": True, },
-    "TuriCreate": { "url": "https://github.com/apple/turicreate.git", "day_interval": 60, "all_commits": True, },
-    "DBeaver": { "url": "https://github.com/dbeaver/dbeaver.git", },
-    "QuantLib": { "url": "https://github.com/lballabio/quantlib.git", },
-    "RocksDB": { "url": "https://github.com/facebook/rocksdb.git", },
-    "emacs": { "url": "https://github.com/emacs-mirror/emacs.git", "day_interval": 60, },
-    "LLVM": { "url": "https://github.com/llvm/llvm-project.git", "day_interval": 60, "all_commits": True, },
-    "gcc": { "url": "https://github.com/gcc-mirror/gcc.git", "day_interval": 60, "all_commits": True, },
-    "Linux": { "url": "https://github.com/torvalds/linux.git", "day_interval": 90, },
-    #"""},
-    }
+# Instead of a fixed "day_interval", a repository can specify a budget of
+# "samples": N commits (or `--samples N` for all), which are spread evenly
+# over its history. With a budget, repositories with less than
+# `MIN_merge_commits` merge commits are sampled from all commits.
+
+# Only the directories in "include_paths": [...] are counted, and the ones in
+# "exclude_paths": [...] are skipped (paths relative to the repository root,
+# e.g. "include_paths": ["core", "cuda"], "exclude_paths": ["third_party"]).
+# Working trees are sparse checkouts of these paths, so the other
+# directories are never written to disk.
+
+# Repositories to process: name -> options, read from CONFIG_file at startup.
+# Entries with "disabled": true are skipped.
+git_repositories = {}
 
 def decode(b_str):
     return b_str.decode("utf-8", "backslashreplace")
@@ -166,6 +198,7 @@ def decode(b_str):
 class CmdOutput:
     def __init__(self, sp_completed_process):
         self.ret_code = sp_completed_process.returncode
+        self.raw_output = sp_completed_process.stdout
         self.output = self.format_output_(sp_completed_process.stdout)
         self.error = self.format_output_(sp_completed_process.stderr)
 
@@ -176,8 +209,94 @@ class CmdOutput:
         return f_list
 
 
-def run_cmd(cmd, allow_failure=False):
-    sp = subprocess.run(cmd, capture_output=True)
+def trace(stage, seconds, **fields):
+    """Appends one event of `stage` that took `seconds` to `TRACE_file`,
+    together with the current repository and commit and the `fields`."""
+    global TRACE_fd, TRACE_pid
+    if not TRACE_file:
+        return
+    event = {"time": round(time.time(), 3), "pid": os.getpid(), "repo": TRACE_repo,
+             "commit": getattr(TRACE_context, "commit", None), "stage": stage,
+             "seconds": round(seconds, 6)}
+    event.update(fields)
+    line = (json.dumps(event) + '\n').encode()
+    with TRACE_lock:
+        if TRACE_pid != os.getpid():
+            # Every (forked) process appends with its own descriptor
+            TRACE_fd = os.open(TRACE_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            TRACE_pid = os.getpid()
+        os.write(TRACE_fd, line)
+
+
+def cmd_stage_(cmd):
+    """Returns the stage name of a command, e.g. "git checkout" or "cloc"."""
+    if cmd[0] == GIT_binary:
+        return ' '.join(["git"] + [arg for arg in cmd[1:] if not arg.startswith('-')][:1])
+    if cmd[0] == CLOC_binary:
+        return "cloc"
+    return os.path.basename(cmd[0])
+
+
+def run_cmd(cmd, allow_failure=False, cwd=None, input=None):
+    begin = time.time()
+    sp = subprocess.run(cmd, capture_output=True, cwd=cwd, input=input)
+    if TRACE_file:
+        trace(cmd_stage_(cmd), time.time() - begin, bytes=len(sp.stdout),
+              rows=sp.stdout.count(b'\n'), returncode=sp.returncode)
+    if PRINT_DEBUG and sp.returncode != 0:
+        print("Command {c} failed with error code {e}\n".format(c=cmd, e=sp.returncode)
+              + "Output:\n{out}\nError:\n{err}\n".format(out=sp.stdout, err=sp.stderr))
+    if not allow_failure:
+        sp.check_returncode()
+    return CmdOutput(sp)
+
+
+def stream_cmd(cmd, cwd=None):
+    """Runs `cmd` and yields its output line by line (decoded, without the
+    newline) while it is running, so the output is never held in memory as
+    a whole. If the consumer stops early (closes the generator), the command
+    is killed. Raises CalledProcessError if the command fails."""
+    begin = time.time()
+    with tempfile.TemporaryFile() as error_file:
+        process = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=error_file)
+        num_bytes = 0
+        rows = 0
+        finished = False
+        try:
+            for line in process.stdout:
+                num_bytes += len(line)
+                rows += 1
+                yield decode(line.rstrip(b'\n'))
+            finished = True
+        finally:
+            if not finished:
+                process.kill()
+            process.stdout.close()
+            ret_code = process.wait()
+            if TRACE_file:
+                trace(cmd_stage_(cmd), time.time() - begin, bytes=num_bytes, rows=rows,
+                      returncode=ret_code, stopped_early=not finished)
+        if ret_code != 0:
+            error_file.seek(0)
+            error = error_file.read()
+            if PRINT_DEBUG:
+                print("Command {c} failed with error code {e}\n".format(c=cmd, e=ret_code)
+                      + "Error:\n{err}\n".format(err=error))
+            raise subprocess.CalledProcessError(ret_code, cmd, None, error)
+
+
+async def run_cmd_async(cmd, allow_failure=False, cwd=None, repo=None):
+    """Like `run_cmd`, but does not block the event loop. `repo` is the
+    repository the command is traced for (see `trace`)."""
+    begin = time.time()
+    process = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdout=subprocess.PIPE,
+                                                   stderr=subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+    sp = subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+    if TRACE_file:
+        trace(cmd_stage_(cmd), time.time() - begin, bytes=len(sp.stdout),
+              rows=sp.stdout.count(b'\n'), returncode=sp.returncode,
+              **({"repo": repo} if repo else {}))
     if PRINT_DEBUG and sp.returncode != 0:
         print("Command {c} failed with error code {e}\n".format(c=cmd, e=sp.returncode)
               + "Output:\n{out}\nError:\n{err}\n".format(out=sp.stdout, err=sp.stderr))
@@ -186,7 +305,61 @@ def run_cmd(cmd, allow_failure=False):
     return CmdOutput(sp)
 
 
-def call_cloc(info_dict):
+def get_filter_langs(info_dict):
+    """Returns a tuple of a bool, which is True if ALL languages should be
+    counted (in which case the SUM entry is used), and the list of languages
+    that are added up to the LOC otherwise."""
+    use_all = ("langs" in info_dict and isinstance(info_dict["langs"], str) and info_dict["langs"] == "ALL")
+    filter_langs = []
+    if "langs" not in info_dict:
+        filter_langs = default_languages
+    # Use the languages specified in `info_dict["langs"]`
+    elif not use_all:
+        filter_langs = info_dict["langs"]
+    return use_all, filter_langs
+
+
+def get_count_paths(info_dict):
+    """Returns the tuple of the directories to count (empty for the whole
+    repository) and the directories to skip, without surrounding slashes."""
+    includes = [path.strip('/') for path in info_dict.get("include_paths", [])]
+    excludes = [path.strip('/') for path in info_dict.get("exclude_paths", [])]
+    return includes, excludes
+
+
+def is_path_counted(info_dict, path):
+    """Returns whether the file `path` (relative to the repository root) lies
+    in the counted directories of `info_dict`."""
+    includes, excludes = get_count_paths(info_dict)
+    in_dirs = lambda dirs: any(path.startswith(d + '/') for d in dirs)
+    return (not includes or in_dirs(includes)) and not in_dirs(excludes)
+
+
+def get_pathspec(info_dict):
+    """Returns the git pathspec that limits a command to the counted
+    directories, or an empty list for the whole repository."""
+    includes, excludes = get_count_paths(info_dict)
+    if not includes and not excludes:
+        return []
+    return ["--"] + includes + [":(exclude){}".format(path) for path in excludes]
+
+
+def get_sparse_checkout_cmd(info_dict):
+    """Returns the `git sparse-checkout` command that only checks out the
+    counted directories, or None if the whole repository is counted. Cone
+    mode is used unless directories are excluded, which it cannot express."""
+    includes, excludes = get_count_paths(info_dict)
+    if not includes and not excludes:
+        return None
+    if not excludes:
+        return [GIT_binary, "sparse-checkout", "set", "--cone"] + includes
+    patterns = ["/{}/".format(path) for path in includes] or ["/*"]
+    patterns.extend("!/{}/".format(path) for path in excludes)
+    return [GIT_binary, "sparse-checkout", "set", "--no-cone"] + patterns
+
+
+def get_cloc_cmd(info_dict):
+    """Returns the cloc command (without the input) shared by all cloc calls."""
     cmd = [CLOC_binary,
               "--quiet",
               "--csv",
@@ -195,55 +368,1527 @@ def call_cloc(info_dict):
           ]
     if "add_cloc_args" in info_dict:
         cmd.extend(info_dict["add_cloc_args"])
-    cmd.append("./") # already in correct directory
+    return cmd
+
+
+def call_cloc_languages(info_dict, repo_dir=None):
+    """Runs cloc in `repo_dir` and returns its full per-language table as a
+    dictionary language -> (files, blank, comment, code)."""
+    cmd = get_cloc_cmd(info_dict)
+    includes, _ = get_count_paths(info_dict)
+    if includes:
+        # Files at the root are part of every sparse checkout
+        includes = [path for path in includes
+                    if os.path.exists(os.path.join(repo_dir or ".", path))]
+        if not includes:
+            return {}
+        cmd.extend(includes)
+    else:
+        cmd.append("./") # already in correct directory
 
     # Run cloc command
-    output = run_cmd(cmd).output
+    output = run_cmd(cmd, cwd=repo_dir).output
 
     # format output
     data_start = 0
     while data_start < len(output) and output[data_start] == '':
         data_start += 1
     data_start += 1 # Also drop the header of the CSV output
-    loc_table = []
-    for line in output[data_start:]:
-        loc_table.append(line.split(CSV_delim))
-    language_idx = 1
-    loc_idx = -1
-
-    # Add only the specified languages
-    loc = 0
-    loc_sum = 0
-    filter_langs = []
-    use_all = ("langs" in info_dict and isinstance(info_dict["langs"], str) and info_dict["langs"] == "ALL")
-    
-    if "langs" not in info_dict:
-        filter_langs = default_languages
-    # Use the languages specified in `info_dict["langs"]`
-    elif not use_all:
-        filter_langs = info_dict["langs"]
-    # ALL languages specified -> use the SUM entry
+    # Columns: files, language, blank, comment, code
+    lang_counts = {}
     for line in output[data_start:]:
         row = line.split(CSV_delim)
         # If the delimiter was not properly used, try the ',' separator
         if len(row) == 1:
             row = row[0].split(',')
-        if len(row) > 1 and row[language_idx] in filter_langs:
-            loc += int(row[loc_idx])
-        if len(row) > 1 and row[language_idx] == "SUM":
-            loc_sum = int(row[loc_idx])
+        if len(row) < 5 or row[1] == "SUM":
+            continue
+        lang_counts[row[1]] = (int(row[0]), int(row[2]), int(row[3]), int(row[4]))
+    return lang_counts
 
-    if use_all:
-        loc = loc_sum
 
+def filter_loc(info_dict, lang_counts):
+    """Returns the tuple (loc, loc_sum) of the per-language table
+    `lang_counts` (see `call_cloc_languages`): loc only adds up the
+    languages specified in `info_dict`, loc_sum adds up all of them."""
+    loc_idx = -1
+    loc_sum = sum(counts[loc_idx] for counts in lang_counts.values())
+    use_all, filter_langs = get_filter_langs(info_dict)
+    # ALL languages specified -> use the sum of all
+    if use_all:
+        return loc_sum, loc_sum
+    # Add only the specified languages
+    loc = sum(counts[loc_idx] for lang, counts in lang_counts.items() if lang in filter_langs)
     return loc, loc_sum
 
 
-def own_print(out_file, string):
-    out_file.write(string + '\n')
-    print(string)
+def call_cloc(info_dict, repo_dir=None):
+    return filter_loc(info_dict, call_cloc_languages(info_dict, repo_dir))
+
+
+class BlobReader:
+    """Streams blob contents out of the object database of a repository with
+    a single long-lived `git cat-file --batch` process. Blobs that are missing
+    in a partial (`--filter=blob:none`) clone are fetched on demand by git,
+    one request per blob, unless they were fetched in advance by `fetch`."""
+    def __init__(self, repo_dir):
+        self.repo_dir = repo_dir
+        self.process = subprocess.Popen([GIT_binary, "cat-file", "--batch"], cwd=repo_dir,
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def read(self, blob):
+        self.process.stdin.write((blob + '\n').encode())
+        self.process.stdin.flush()
+        # Header: "<hash> blob <size>" or "<hash> missing"
+        header = self.process.stdout.readline().split()
+        if len(header) != 3:
+            raise RuntimeError("Unable to read blob {}: {}".format(blob, decode(b' '.join(header))))
+        data = self.process.stdout.read(int(header[2]))
+        self.process.stdout.read(1) # trailing newline
+        return data
+
+    def fetch(self, blobs):
+        """Fetches the `blobs` missing in a partial clone in a single batch.
+        Blobs that are already present are skipped by git without contacting
+        the remote. On failure, the blobs are still fetched one by one by
+        `read`."""
+        if not blobs:
+            return
+        run_cmd([GIT_binary, "-c", "fetch.negotiationAlgorithm=noop", "fetch", "origin",
+                 "--no-tags", "--no-write-fetch-head", "--recurse-submodules=no",
+                 "--filter=blob:none", "--stdin"], True, cwd=self.repo_dir,
+                input=('\n'.join(blobs) + '\n').encode())
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class BlobCache:
+    """Persistent SQLite cache mapping (blob hash, file name, cloc options)
+    to the (language, blank, comment, code) counts of the blob.
+    The cloc options include the counting tool, its version and all
+    arguments, so changing any of them never returns stale counts. Every entry remembers when it was last
+    used, and the least recently used entries are evicted on `close` once the
+    cache holds more than `BLOB_cache_max_entries` entries."""
+    def __init__(self, info_dict, path=None):
+        if path is None:
+            path = BLOB_cache_file
+        options = get_counter_version(info_dict)
+        options += ' ' + ' '.join(get_cloc_cmd(info_dict)[1:])
+        self.options = hashlib.sha1(options.encode()).hexdigest()[:16]
+        self.now = int(time.time())
+        # Multiple workers may use the cache at the same time
+        self.db = sqlite3.connect(path, timeout=300)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS blob_counts ("
+                        "blob TEXT, file_name TEXT, options TEXT, language TEXT, "
+                        "blank INTEGER, comment INTEGER, code INTEGER, last_used INTEGER, "
+                        "PRIMARY KEY (blob, file_name, options)) WITHOUT ROWID")
+        self.db.execute("CREATE INDEX IF NOT EXISTS blob_counts_last_used "
+                        "ON blob_counts (last_used)")
+        self.db.commit()
+
+    def get(self, key):
+        """Returns the counts for the (blob hash, file name) `key`, or None."""
+        return self.db.execute("SELECT language, blank, comment, code FROM blob_counts "
+                               "WHERE blob=? AND file_name=? AND options=?",
+                               (key[0], key[1], self.options)).fetchone()
+
+    def touch(self, keys):
+        """Marks the entries of `keys` as used now for the LRU eviction."""
+        self.db.executemany("UPDATE blob_counts SET last_used=? "
+                            "WHERE blob=? AND file_name=? AND options=?",
+                            [(self.now, key[0], key[1], self.options) for key in keys])
+        self.db.commit()
+
+    def put(self, items):
+        """Stores the (key, counts) `items` in the cache."""
+        self.db.executemany("INSERT OR REPLACE INTO blob_counts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            [(key[0], key[1], self.options) + tuple(counts) + (self.now,)
+                             for key, counts in items])
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        num_entries = self.db.execute("SELECT COUNT(*) FROM blob_counts").fetchone()[0]
+        if num_entries > BLOB_cache_max_entries:
+            # Evict down to 90% of the limit, so this does not happen every time
+            num_evict = num_entries - (BLOB_cache_max_entries * 9) // 10
+            self.db.execute("DELETE FROM blob_counts WHERE (blob, file_name, options) IN "
+                            "(SELECT blob, file_name, options FROM blob_counts "
+                            "ORDER BY last_used LIMIT ?)", (num_evict,))
+            self.db.commit()
+        self.db.close()
+
+
+class IncrementalCounter:
+    """Counts the LOC of consecutive commits of one repository by only
+    counting the files that changed since the previously counted commit.
+    The line counts of every file are kept in memory, keyed by the blob hash
+    (and the file name, since cloc determines the language from it), so
+    files that reappear (reverts, copies, moves) are never counted twice.
+
+    If `from_objects` is True, the commits do not need to be checked out:
+    only the blobs that need counting are read from the object database and
+    written to a scratch directory for cloc. In blobless clones, the missing
+    blobs of a commit are fetched in a single batch before counting it.
+    If the counting tool is "python", the files are counted in-process by
+    line_counter.LineCounter instead of cloc.
+    If a `blob_cache` (BlobCache) is given, it is consulted before counting
+    a blob, and newly counted blobs are added to it.
+
+    Like cloc, files with identical content are only counted once: for every
+    blob, the paths of the current commit in a recognized language are kept,
+    and the blob is counted once with the language of the smallest of them.
+    The result therefore does not depend on the order the commits are
+    counted in.
+    """
+    def __init__(self, info_dict, repo_dir, from_objects=False, blob_cache=None):
+        self.info_dict = info_dict
+        self.repo_dir = repo_dir
+        self.blob_cache = blob_cache
+        self.line_counter = None
+        if get_count_tool(info_dict) == "python":
+            self.line_counter = line_counter.LineCounter(get_cloc_cmd(info_dict))
+        self.blob_reader = None
+        self.scratch_dir = None
+        self.blobless = from_objects and info_dict.get("blobless", USE_blobless)
+        if from_objects:
+            self.blob_reader = BlobReader(repo_dir)
+        if from_objects and not self.line_counter:
+            self.scratch_dir = tempfile.mkdtemp(prefix=os.path.basename(repo_dir) + "_blobs_",
+                                                dir=os.path.dirname(os.path.abspath(repo_dir)))
+        cloc_cmd = get_cloc_cmd(info_dict)
+        self.exclude_dirs = set()
+        for arg in cloc_cmd:
+            if arg.startswith("--exclude-dir="):
+                self.exclude_dirs.update(arg[len("--exclude-dir="):].split(','))
+        self.commit = None
+        self.files = {}         # path -> blob hash of the current commit
+        self.blob_counts = {}   # (blob hash, file name) -> (language, blank, comment, code)
+        self.blob_paths = {}    # blob hash -> paths of the blob in a recognized language
+        self.blob_counted = {}  # blob hash -> key the blob is counted with
+        self.lang_counts = {}   # language -> [files, blank, comment, code]
+
+    def is_excluded_(self, mode, path):
+        # Skip submodules and symbolic links, which cloc does not follow either
+        if mode in ("160000", "120000"):
+            return True
+        if not is_path_counted(self.info_dict, path):
+            return True
+        return any(d in self.exclude_dirs for d in path.split('/')[:-1])
+
+    def blob_key_(self, blob, path):
+        return blob, os.path.basename(path)
+
+    def list_changes_(self, commit):
+        """Returns the list of (removed, added) tuples of (path, blob) entries
+        between the current and the given commit. `None` signals absence."""
+        changes = []
+        if self.commit is None:
+            # ls-tree does not support excluding pathspecs
+            includes, _ = get_count_paths(self.info_dict)
+            out = run_cmd([GIT_binary, "ls-tree", "-r", "-z", commit] + includes,
+                          cwd=self.repo_dir).raw_output
+            for entry in decode(out).split('\0'):
+                if not entry:
+                    continue
+                meta, path = entry.split('\t', 1)
+                mode, _, blob = meta.split(' ')
+                if not self.is_excluded_(mode, path):
+                    changes.append((None, (path, blob)))
+            return changes
+        out = run_cmd([GIT_binary, "diff", "--raw", "--no-abbrev", "--no-renames", "-z",
+                       self.commit, commit] + get_pathspec(self.info_dict),
+                      cwd=self.repo_dir).raw_output
+        entries = decode(out).split('\0')
+        # Each change consists of ":<old mode> <new mode> <old blob> <new blob> <status>"
+        # followed by the path
+        for meta, path in zip(entries[0::2], entries[1::2]):
+            old_mode, new_mode, old_blob, new_blob, _ = meta[1:].split(' ')
+            removed = None
+            added = None
+            if path in self.files:
+                removed = (path, self.files[path])
+            if set(new_blob) != {'0'} and not self.is_excluded_(new_mode, path):
+                added = (path, new_blob)
+            if removed or added:
+                changes.append((removed, added))
+        return changes
+
+    def write_blobs_(self, entries):
+        """Writes the blobs of the (path, blob) `entries` to the scratch
+        directory, keeping their path, so cloc sees the same file names."""
+        shutil.rmtree(self.scratch_dir)
+        os.makedirs(self.scratch_dir)
+        for path, blob in entries:
+            file_path = os.path.join(self.scratch_dir, path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "wb") as blob_file:
+                blob_file.write(self.blob_reader.read(blob))
+
+    def count_files_in_process_(self, entries):
+        counts = {}
+        for path, blob in entries:
+            if self.blob_reader:
+                data = self.blob_reader.read(blob)
+            else:
+                with open(os.path.join(self.repo_dir, path), "rb") as input_file:
+                    data = input_file.read()
+            file_counts = self.line_counter.count(path, data)
+            if file_counts:
+                counts[path] = file_counts
+        return counts
+
+    def count_files_(self, entries):
+        """Counts the files of the (path, blob) `entries` with cloc and
+        returns a dictionary path -> (language, blank, comment, code)."""
+        counts = {}
+        if not entries:
+            return counts
+        if self.line_counter:
+            return self.count_files_in_process_(entries)
+        count_dir = self.repo_dir
+        if self.blob_reader:
+            self.write_blobs_(entries)
+            count_dir = self.scratch_dir
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as list_file:
+            list_file.write('\n'.join(path for path, _ in entries) + '\n')
+            list_file.flush()
+            cmd = get_cloc_cmd(self.info_dict)
+            # Identical files are only counted once by `count`, not by cloc
+            cmd.extend(["--by-file", "--skip-uniqueness",
+                        "--list-file={}".format(list_file.name)])
+            output = run_cmd(cmd, cwd=count_dir).output
+        # Rows: language, filename, blank, comment, code
+        for line in output:
+            row = line.split(CSV_delim)
+            if len(row) < 5 or row[0] in ("language", "SUM"):
+                continue
+            path = CSV_delim.join(row[1:-3])
+            if path.startswith("./"):
+                path = path[2:]
+            counts[path] = (row[0], int(row[-3]), int(row[-2]), int(row[-1]))
+        return counts
+
+    def update_lang_(self, key, sign):
+        language, blank, comment, code = self.blob_counts[key]
+        if language is None:
+            return
+        entry = self.lang_counts.setdefault(language, [0, 0, 0, 0])
+        for i, value in enumerate((1, blank, comment, code)):
+            entry[i] += sign * value
+        if entry[0] == 0:
+            del self.lang_counts[language]
+
+    def recount_blob_(self, blob):
+        """Counts `blob` with the smallest of its paths, or not at all if none
+        of its paths is in a recognized language."""
+        paths = self.blob_paths.get(blob)
+        key = None
+        if paths:
+            key = self.blob_key_(blob, min(paths))
+        else:
+            self.blob_paths.pop(blob, None)
+        old_key = self.blob_counted.get(blob)
+        if key == old_key:
+            return
+        if old_key:
+            self.update_lang_(old_key, -1)
+            del self.blob_counted[blob]
+        if key:
+            self.update_lang_(key, 1)
+            self.blob_counted[blob] = key
+
+    def count(self, commit):
+        """Updates the line counts to `commit` and returns the tuple
+        (loc, loc_sum). Unless reading from the object database, `commit`
+        must be checked out in `repo_dir`."""
+        changes = self.list_changes_(commit)
+        new_paths = {}
+        cache_hits = []
+        for _, added in changes:
+            key = self.blob_key_(added[1], added[0]) if added else None
+            if key is None or key in self.blob_counts or key in new_paths:
+                continue
+            cached = self.blob_cache.get(key) if self.blob_cache else None
+            if cached is not None:
+                self.blob_counts[key] = tuple(cached)
+                cache_hits.append(key)
+            else:
+                new_paths[key] = added
+        if cache_hits:
+            self.blob_cache.touch(cache_hits)
+        if self.blobless:
+            self.blob_reader.fetch(sorted({blob for _, blob in new_paths.values()}))
+        begin = time.time()
+        counted = self.count_files_(sorted(new_paths.values()))
+        trace("count files", time.time() - begin, files=len(new_paths),
+              cache_hits=len(cache_hits), changes=len(changes))
+        for key, (path, _) in new_paths.items():
+            # Files cloc does not recognize are remembered with no language
+            self.blob_counts[key] = counted.get(path, (None, 0, 0, 0))
+        if self.blob_cache and new_paths:
+            self.blob_cache.put([(key, self.blob_counts[key]) for key in new_paths])
+
+        touched = set()
+        for removed, added in changes:
+            if removed:
+                path, blob = removed
+                self.blob_paths.get(blob, set()).discard(path)
+                del self.files[path]
+                touched.add(blob)
+            if added:
+                path, blob = added
+                if self.blob_counts[self.blob_key_(blob, path)][0] is not None:
+                    self.blob_paths.setdefault(blob, set()).add(path)
+                self.files[path] = blob
+                touched.add(blob)
+        for blob in touched:
+            self.recount_blob_(blob)
+        self.commit = commit
+        return filter_loc(self.info_dict, self.lang_counts)
+
+    def language_counts(self):
+        """Returns the per-language table of the current commit as a
+        dictionary language -> (files, blank, comment, code)."""
+        return {lang: tuple(entry) for lang, entry in self.lang_counts.items()}
+
+    def close(self):
+        if self.blob_reader:
+            self.blob_reader.close()
+        if self.scratch_dir:
+            shutil.rmtree(self.scratch_dir, True)
+        if self.blob_cache:
+            self.blob_cache.close()
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?"
+    seconds = int(seconds)
+    return "{}:{:02}:{:02}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def status_dir():
+    return os.path.join(OUT_dir_tmp, "status")
+
+
+class ProgressReporter:
+    """Tracks the progress of one repository: its state ("pending",
+    "preparing", "counting", "done", "failed" or "deferred") and, while
+    counting, the number of counted commits. The remaining time is estimated from the
+    moving average of the time between the last `PROGRESS_window` counted
+    commits, so it also holds for sharded counting.
+    Updates are written to the status files at most every `STATUS_interval`
+    seconds (and on every state change) and printed with PRINT_DEBUG.
+    `started` is the time the repository started to be prepared, if that
+    happened in another process."""
+    def __init__(self, name, started=None):
+        self.name = name
+        self.path = os.path.join(status_dir(), name + ".json")
+        self.lock = threading.Lock()
+        self.state = "pending"
+        self.total = 0
+        self.done = 0
+        self.started = started
+        self.last_commit = None
+        self.intervals = []
+        self.last_write = 0.0
+
+    def set_state(self, state):
+        with self.lock:
+            self.state = state
+            if state == "preparing":
+                self.started = time.time()
+            self.write_(True)
+
+    def start_counting(self, total):
+        with self.lock:
+            self.state = "counting"
+            if self.started is None:
+                self.started = time.time()
+            self.total = total
+            self.done = 0
+            self.last_commit = time.time()
+            self.write_(True)
+
+    def commit_counted(self):
+        with self.lock:
+            now = time.time()
+            self.intervals.append(now - self.last_commit)
+            self.intervals = self.intervals[-PROGRESS_window:]
+            self.last_commit = now
+            self.done += 1
+            if now - self.last_write >= STATUS_interval or self.done == self.total:
+                if PRINT_DEBUG:
+                    print("Progress {}: {}/{} commits, ETA {}".format(
+                        self.name, self.done, self.total, format_duration(self.eta_())))
+                self.write_(False)
+
+    def eta_(self):
+        if self.state in ("done", "failed"):
+            return 0.0
+        if self.state != "counting" or not self.intervals:
+            return None
+        return (self.total - self.done) * sum(self.intervals) / len(self.intervals)
+
+    def write_(self, force):
+        now = time.time()
+        if not force and now - self.last_write < STATUS_interval:
+            return
+        self.last_write = now
+        status = {"name": self.name, "state": self.state, "pid": os.getpid(),
+                  "done": self.done, "total": self.total, "updated": now,
+                  "elapsed": now - self.started if self.started else 0.0,
+                  "eta": self.eta_()}
+        if self.intervals:
+            status["seconds_per_commit"] = sum(self.intervals) / len(self.intervals)
+        loc_storage.write_file_atomic(self.path, [json.dumps(status) + '\n'])
+        merge_status()
+
+
+def merge_status():
+    """Merges the states of all repositories into `STATUS_file`, adding the
+    totals and the estimated remaining time of the whole run. Repositories
+    that have not started yet are estimated with the average duration of the
+    finished ones."""
+    with open(os.path.join(status_dir(), ".lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        repos = {}
+        for el in sorted(os.listdir(status_dir())):
+            if el.endswith(".json"):
+                try:
+                    with open(os.path.join(status_dir(), el), 'r') as status_file:
+                        status = json.load(status_file)
+                except ValueError:
+                    continue
+                repos[status["name"]] = status
+        states = [status["state"] for status in repos.values()]
+        finished = [status["elapsed"] for status in repos.values() if status["state"] == "done"]
+        running = [status for status in repos.values()
+                   if status["state"] in ("preparing", "counting")]
+        average = sum(finished) / len(finished) if finished else None
+        pending = states.count("pending")
+        # Unknown (None) until there is something to extrapolate from
+        eta = 0.0
+        for status in running:
+            if status["eta"] is not None:
+                eta += status["eta"]
+            elif average is not None:
+                eta += max(0.0, average - status["elapsed"])
+            else:
+                eta = None
+                break
+        if eta is not None and pending:
+            eta = pending * average + eta if average is not None else None
+        if eta is not None:
+            eta /= max(1, min(NUM_jobs, len(running) + pending))
+        overall = {"repositories": len(repos),
+                   "states": {state: states.count(state) for state in sorted(set(states))},
+                   "commits_done": sum(status["done"] for status in repos.values()),
+                   "commits_known": sum(status["total"] for status in repos.values()),
+                   "eta": eta, "updated": time.time()}
+        loc_storage.write_file_atomic(STATUS_file, [json.dumps(
+            {"overall": overall, "repositories": repos}, indent=4, sort_keys=True) + '\n'])
+
+
+def init_status(names):
+    """Marks all repositories in `names` as pending in fresh status files."""
+    shutil.rmtree(status_dir(), True)
+    os.makedirs(status_dir())
+    for name in names:
+        ProgressReporter(name).write_(True)
+
+
+class ResultLog:
+    """Durable, append-only log of the result rows (and the per-language
+    tables) of one repository. Every entry is flushed and fsync'd as soon as
+    its commit is counted, so the log doubles as the checkpoint of the
+    commits that are done: an interrupted run resumes exactly where it
+    stopped. Entries may be appended from multiple threads."""
+    def __init__(self, path):
+        self.path = path
+        self.rows = {}  # commit -> row
+        self.lang_counts = {}  # commit -> per-language table
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r+") as log_file:
+                content = log_file.read()
+                # Drop a partially written last row
+                complete = content[:content.rfind('\n') + 1]
+                if len(complete) != len(content):
+                    log_file.truncate(len(complete.encode()))
+            for line in complete.splitlines():
+                entry = json.loads(line)
+                commit = entry["row"].split(OUT_delim)[1]
+                self.rows[commit] = entry["row"]
+                self.lang_counts[commit] = entry["langs"]
+        self.log_file = open(path, "a")
+
+    def done(self, commit):
+        return commit in self.rows
+
+    def append(self, commit, row, lang_counts):
+        with self.lock:
+            self.log_file.write(json.dumps({"row": row, "langs": lang_counts}) + '\n')
+            self.log_file.flush()
+            os.fsync(self.log_file.fileno())
+            self.rows[commit] = row
+            self.lang_counts[commit] = lang_counts
+
+    def close(self):
+        self.log_file.close()
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+def use_no_checkout(idict):
+    return idict.get("no_checkout", NO_checkout)
+
+
+def get_count_tool(idict):
+    return idict.get("counter", COUNT_tool)
+
+
+def use_incremental(idict):
+    """Returns whether the commits are counted by IncrementalCounter instead
+    of a cloc run over the whole checkout."""
+    return (use_no_checkout(idict) or idict.get("blob_cache", USE_blob_cache)
+            or get_count_tool(idict) == "python" or idict.get("incremental", USE_incremental))
+
+
+def get_counter_version(idict):
+    """Returns the name and version of the tool that counts the lines."""
+    if get_count_tool(idict) == "python":
+        return "python " + line_counter.VERSION
+    return CLOC_version
+
+
+def read_history(repo_dir, log_ref, stop_timestamp=None, since_commit=None, merges_only=False):
+    """Streams the history of `log_ref` with `git log` and yields a
+    (timestamp, date, commit, commit timestamp) tuple per commit, in the
+    order of git log (newest committer date first). The timestamps are the
+    author and committer date in seconds since the epoch (UTC), the date is
+    the author date in ISO format.
+    If `merges_only` is True, only the merge commits into the current branch
+    (the merges of the first-parent chain) are read.
+    If `stop_timestamp` is given, reading stops at the first commit that was
+    committed at or before it. git lists commits newest committer date
+    first, and a commit is never committed before it was authored, so all
+    commits authored after `stop_timestamp` are still read.
+    If `since_commit` is given, only the commits that are not reachable from
+    it are read (`since_commit..log_ref`)."""
+    if since_commit:
+        log_ref = "{}..{}".format(since_commit, log_ref)
+    cmd = [GIT_binary, "log",
+           "--date=iso-strict",
+           "--pretty=format:%at{d}%ct{d}%ad{d}%H".format(d=LOG_delim),
+          ]
+    if merges_only:
+        cmd.extend(["--first-parent", "--min-parents=2"])
+    lines = stream_cmd(cmd + [log_ref], cwd=repo_dir)
+    try:
+        for line in lines:
+            spl = line.split(LOG_delim)
+            if stop_timestamp is not None and int(spl[1]) <= stop_timestamp:
+                break
+            yield int(spl[0]), spl[2], spl[3], int(spl[1])
+    finally:
+        lines.close()
+
+
+def sort_by_author_date(history):
+    """Yields the entries of `history` (see `read_history`) sorted by author
+    date, newest first, and entries with the same author date in the order of
+    `history`. Since a commit is never committed before it was authored, an
+    entry is final as soon as a later one was committed before it was
+    authored, so only the entries in between are kept in memory."""
+    pending = []
+    for idx, entry in enumerate(history):
+        while pending and -pending[0][0] > entry[3]:
+            yield heapq.heappop(pending)[2]
+        heapq.heappush(pending, (-entry[0], idx, entry))
+    while pending:
+        yield heapq.heappop(pending)[2]
+
+
+def get_sample_interval(idict, candidates):
+    """Returns the tuple of the distance in seconds between two counted
+    commits and whether that distance is measured between evenly spaced
+    target times (True) or between the counted commits (False).
+    The distance is either "day_interval", or it is computed from the budget
+    of "samples" commits spread evenly over the history of `candidates`."""
+    if "day_interval" in idict:
+        return idict["day_interval"] * 24 * 60 * 60, False
+    num_samples = idict.get("samples", NUM_samples)
+    if num_samples and len(candidates) > num_samples:
+        timestamps = [entry[0] for entry in candidates]
+        return (max(timestamps) - min(timestamps)) / max(1, num_samples - 1), True
+    return 0, False
+
+
+def select_commits(idict, candidates, newest_processed_timestamp):
+    """Returns the list of (date, commit) tuples from the `candidates` (see
+    `read_history`) that need to be counted, newest first. `candidates` is
+    consumed as a stream and only the selected commits are kept, except with
+    a sample budget, which needs the list of all candidates. Stops at the first commit that is not newer
+    than `newest_processed_timestamp` and keeps the sample interval (see
+    `get_sample_interval`) between two selected commits. With evenly spaced
+    target times, the newest commit at or before each target is selected.
+    The targets continue the grid of the already processed commits, and at
+    most "samples" commits are selected.
+    All distances are computed from UTC timestamps, so time zones do not
+    matter."""
+    interval, on_grid = get_sample_interval(idict, candidates)
+    num_samples = idict.get("samples", NUM_samples) if on_grid else None
+    if on_grid and interval <= 0:
+        # All candidates have the same timestamp
+        on_grid = False
+    commits = []
+    next_target = None
+    if on_grid and newest_processed_timestamp > float("-inf") and candidates:
+        # Only add a commit once the next target after the newest processed
+        # one is reached, instead of always adding the newest commit
+        newest = max(entry[0] for entry in candidates)
+        next_target = (newest_processed_timestamp
+                       + (newest - newest_processed_timestamp) // interval * interval)
+    for timestamp, date, commit, _ in sort_by_author_date(candidates):
+        if newest_processed_timestamp >= timestamp:
+            if PRINT_DEBUG:
+                print("Reached older commit than processed previously. Finishing up...")
+            # Reached a point that has already been processed
+            break
+        # Note: we look at the commits current -> last
+        if next_target is not None and timestamp > next_target:
+            continue
+        if num_samples and len(commits) >= num_samples:
+            break
+        commits.append((date, commit))
+        if on_grid:
+            if next_target is None:
+                next_target = timestamp
+            # Skip the targets without any commit in between
+            while next_target >= timestamp:
+                next_target -= interval
+        else:
+            next_target = timestamp - interval
+    return commits
+
+
+def read_trees(repo_dir, commits):
+    """Returns the dictionary commit -> tree hash of all `commits`, resolved
+    with a single git process."""
+    if not commits:
+        return {}
+    out = run_cmd([GIT_binary, "cat-file", "--batch-check=%(objectname)"], cwd=repo_dir,
+                  input=''.join(commit + "^{tree}\n" for commit in commits).encode())
+    return dict(zip(commits, out.output))
+
+
+def count_commits(idict, repo_dir, commits, on_row=None, tree_counts=None):
+    """Checks out every commit of `commits` in `repo_dir` and counts its LOC.
+    Returns the formatted result rows in the same order as `commits`.
+    `on_row(commit, row, lang_counts)` is called as soon as a commit is
+    counted, with the full per-language table of the commit.
+    Commits with the same tree as an already counted commit have the same
+    counts, so they are neither checked out nor counted. `tree_counts` is the
+    dictionary tree hash -> (loc, loc_sum, lang_counts) of the counted trees,
+    which can be shared between calls."""
+    rows = []
+    if tree_counts is None:
+        tree_counts = {}
+    trees = read_trees(repo_dir, [commit for _, commit in commits])
+    no_checkout = use_no_checkout(idict)
+    use_cache = idict.get("blob_cache", USE_blob_cache)
+    counter = None
+    if use_incremental(idict):
+        counter = IncrementalCounter(idict, repo_dir, no_checkout,
+                                     BlobCache(idict) if use_cache else None)
+    checkout_time = 0.0
+    count_time = 0.0
+    try:
+        for date, commit in commits:
+            TRACE_context.commit = commit
+            begin = time.time()
+            tree = trees.get(commit)
+            reused = tree in tree_counts
+            if reused:
+                loc, loc_sum, lang_counts = tree_counts[tree]
+                checked_out = begin
+            else:
+                # check out specific commit and count locs
+                if not no_checkout:
+                    run_cmd([GIT_binary, "checkout", commit], cwd=repo_dir)
+                checked_out = time.time()
+                if counter:
+                    loc, loc_sum = counter.count(commit)
+                    lang_counts = counter.language_counts()
+                else:
+                    lang_counts = call_cloc_languages(idict, repo_dir)
+                    loc, loc_sum = filter_loc(idict, lang_counts)
+                if tree:
+                    tree_counts[tree] = (loc, loc_sum, lang_counts)
+            end = time.time()
+            checkout_time += checked_out - begin
+            count_time += end - checked_out
+            trace("commit", end - begin, checkout=round(checked_out - begin, 6),
+                  count=round(end - checked_out, 6), loc=loc, reused=reused)
+            TRACE_context.commit = None
+            row = "{}{d}{}{d}{}{d}{}".format(date, commit, loc, loc_sum, d=OUT_delim)
+            print(row)
+            if on_row:
+                on_row(commit, row, lang_counts)
+            if PRINT_DEBUG and reused:
+                print("Same tree as an already counted commit")
+            elif PRINT_DEBUG:
+                print("Latency: {:.3f} s (checkout: {:.3f} s, count: {:.3f} s)"
+                      .format(end - begin, checked_out - begin, end - checked_out))
+            rows.append(row)
+    finally:
+        if counter:
+            counter.close()
+        with LATENCY_lock:
+            LATENCY_totals["commits"] += len(rows)
+            LATENCY_totals["checkout"] += checkout_time
+            LATENCY_totals["count"] += count_time
+    if PRINT_DEBUG and commits:
+        print("Average latency of {} commits: {:.3f} s (checkout: {:.3f} s, count: {:.3f} s)"
+              .format(len(commits), (checkout_time + count_time) / len(commits),
+                      checkout_time / len(commits), count_time / len(commits)))
+    return rows
+
+
+def count_commits_sharded(idict, repo_dir, commits, num_shards, on_row=None):
+    """Splits `commits` into `num_shards` contiguous chunks and counts each
+    chunk in its own `git worktree` of `repo_dir`, all sharing the same object
+    store. The rows are returned in the same (newest first) order as
+    `commits`; `on_row` is called from the shards' threads."""
+    chunk_size = -(-len(commits) // num_shards) # ceil division
+    chunks = [commits[i:i + chunk_size] for i in range(0, len(commits), chunk_size)]
+    # Counted trees are shared by all shards
+    tree_counts = {}
+    if use_no_checkout(idict):
+        # Nothing is checked out, so all shards can read the same repository
+        with ThreadPoolExecutor(len(chunks)) as executor:
+            shard_rows = list(executor.map(
+                lambda chunk: count_commits(idict, repo_dir, chunk, on_row, tree_counts),
+                chunks))
+        return [row for rows in shard_rows for row in rows]
+    worktrees = []
+    try:
+        for i, chunk in enumerate(chunks):
+            worktree = "{}_shard{}".format(repo_dir, i)
+            # Left behind by an interrupted run
+            shutil.rmtree(worktree, True)
+            sparse_cmd = get_sparse_checkout_cmd(idict)
+            if sparse_cmd:
+                # Restrict the new worktree before anything is checked out
+                run_cmd([GIT_binary, "worktree", "add", "--no-checkout", "--detach", worktree,
+                         chunk[0][1]], cwd=repo_dir)
+                worktrees.append(worktree)
+                run_cmd(sparse_cmd, cwd=worktree)
+                run_cmd([GIT_binary, "reset", "--hard", "--quiet"], cwd=worktree)
+            else:
+                run_cmd([GIT_binary, "worktree", "add", "--detach", worktree, chunk[0][1]],
+                        cwd=repo_dir)
+                worktrees.append(worktree)
+        # Threads are sufficient since the work happens in git and cloc
+        with ThreadPoolExecutor(len(chunks)) as executor:
+            shard_rows = list(executor.map(
+                lambda args: count_commits(idict, args[0], args[1], on_row, tree_counts),
+                zip(worktrees, chunks)))
+    finally:
+        for worktree in worktrees:
+            run_cmd([GIT_binary, "worktree", "remove", "--force", worktree], True,
+                    cwd=repo_dir)
+        run_cmd([GIT_binary, "worktree", "prune"], True, cwd=repo_dir)
+    return [row for rows in shard_rows for row in rows]
+
+
+async def update_mirror_async(name, idict):
+    """Makes sure an up-to-date bare mirror of the repository exists in
+    `MIRROR_dir` and returns its path. An existing mirror is only fetched, so
+    the cost of a rerun is proportional to the new history.
+    If the fetch fails but the mirror is intact (e.g. the remote is not
+    reachable), the stale mirror is counted; it is only cloned again if it
+    is corrupt."""
+    mirror_dir = os.path.join(MIRROR_dir, name + ".git")
+    if os.path.exists(mirror_dir):
+        await run_cmd_async([GIT_binary, "remote", "set-url", "origin", idict["url"]], True,
+                            cwd=mirror_dir, repo=name)
+        fetch_out = await run_cmd_async([GIT_binary, "fetch", "--prune", "origin"], True,
+                                        cwd=mirror_dir, repo=name)
+        if fetch_out.ret_code == 0:
+            await write_commit_graph_async(name, mirror_dir)
+            return mirror_dir
+        verify_out = await run_cmd_async([GIT_binary, "rev-parse", "--verify", "--quiet",
+                                          idict.get("branch", "HEAD") + "^{commit}"], True,
+                                         cwd=mirror_dir, repo=name)
+        if verify_out.ret_code == 0:
+            print("Warning: fetching {} failed, counting the existing mirror".format(name))
+            return mirror_dir
+        # The mirror is corrupt, start from scratch
+        shutil.rmtree(mirror_dir, False)
+    clone_cmd = [GIT_binary, "clone", "--mirror"]
+    if use_no_checkout(idict) and idict.get("blobless", USE_blobless):
+        clone_cmd.append("--filter=blob:none")
+    if REFERENCE_repo:
+        clone_cmd.extend(["--reference-if-able", REFERENCE_repo])
+    clone_cmd.extend([idict["url"], mirror_dir])
+    await run_cmd_async(clone_cmd, repo=name)
+    await write_commit_graph_async(name, mirror_dir)
+    return mirror_dir
+
+
+async def write_commit_graph_async(name, mirror_dir):
+    """Writes the commit-graph file of the mirror, which speeds up walking
+    the history. With `--split`, only the newly fetched commits are written
+    into a new layer. Fails silently with git versions without commit-graph
+    support."""
+    await run_cmd_async([GIT_binary, "commit-graph", "write", "--reachable", "--split"], True,
+                        cwd=mirror_dir, repo=name)
+
+
+async def read_object_bytes_async(name, repo_dir):
+    """Returns the bytes of the object store of `repo_dir`."""
+    out = await run_cmd_async([GIT_binary, "count-objects", "-v"], cwd=repo_dir, repo=name)
+    object_bytes = 0
+    for line in out.output:
+        key, _, value = line.partition(": ")
+        if key in ("size", "size-pack"):
+            object_bytes += int(value) * 1024
+    return object_bytes
+
+
+async def read_checkout_bytes_async(name, repo_dir, ref, idict):
+    """Returns the bytes of the counted files of `ref`, i.e. the size of its
+    checkout. Needs the sizes of all blobs, so it must not be used with
+    blobless clones."""
+    out = await run_cmd_async([GIT_binary, "ls-tree", "-r", "-l", "-z", ref],
+                              cwd=repo_dir, repo=name)
+    checkout_bytes = 0
+    for entry in decode(out.raw_output).split('\0'):
+        if not entry:
+            continue
+        meta, path = entry.split('\t', 1)
+        size = meta.split()[-1]
+        if size != "-" and is_path_counted(idict, path):
+            checkout_bytes += int(size)
+    return checkout_bytes
+
+
+def estimate_scratch_bytes(idict, object_bytes, checkout_bytes):
+    """Returns the estimated bytes a repository needs in its work directory:
+    its objects and one checkout per shard worktree besides its own."""
+    num_shards = idict.get("shards", NUM_shards)
+    num_checkouts = 1 + num_shards if num_shards > 1 else 1
+    return int((object_bytes + num_checkouts * checkout_bytes) * SCRATCH_factor)
+
+
+def reserve_scratch(scratch_dir, name, needed, budget=None):
+    """Reserves `needed` bytes for repository `name` on the file system of
+    `scratch_dir` if they fit into its free space minus `SCRATCH_reserve` and
+    the reservations of the other repositories being prepared or counted, and
+    into the `budget` of used bytes (None: unlimited). Returns whether the
+    space was reserved. The reservations are shared by all workers through a
+    file in `scratch_dir` and are kept until `release_scratch`."""
+    path = os.path.join(scratch_dir, ".reservations.json")
+    with open(os.path.join(scratch_dir, ".reservations.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        reservations = {}
+        if os.path.exists(path):
+            with open(path, 'r') as in_file:
+                reservations = json.load(in_file)
+        reservations.pop(name, None)
+        reserved = sum(reservations.values())
+        usage = shutil.disk_usage(scratch_dir)
+        if needed + reserved + SCRATCH_reserve > usage.free:
+            return False
+        if budget is not None and usage.used + reserved + needed > budget:
+            return False
+        reservations[name] = needed
+        with open(path, 'w') as out_file:
+            json.dump(reservations, out_file)
+    return True
+
+
+def release_scratch(name):
+    """Releases the scratch space reserved for repository `name`."""
+    for scratch_dir in (RAM_scratch_root, TMP_storage):
+        path = os.path.join(scratch_dir, ".reservations.json") if scratch_dir else None
+        if not path or not os.path.exists(path):
+            continue
+        with open(os.path.join(scratch_dir, ".reservations.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with open(path, 'r') as in_file:
+                reservations = json.load(in_file)
+            if reservations.pop(name, None) is not None:
+                with open(path, 'w') as out_file:
+                    json.dump(reservations, out_file)
+
+
+def select_work_dir(name, work_dir, estimate):
+    """Returns the directory to clone repository `name` into: the RAM-backed
+    counterpart of `work_dir` if the `estimate` (bytes, None if unknown) fits
+    into it, otherwise `work_dir`. Raises an OSError if the free space of
+    `work_dir` does not suffice, so the run does not fail halfway.
+    The space is reserved (see `reserve_scratch`), so repositories prepared
+    at the same time cannot all take the same free space."""
+    needed = estimate or 0
+    if RAM_scratch_root and estimate is not None:
+        ram_dir = os.path.join(RAM_scratch_root, os.path.relpath(work_dir, TMP_storage))
+        os.makedirs(ram_dir, exist_ok=True)
+        if reserve_scratch(RAM_scratch_root, name, needed, RAM_scratch_budget):
+            if PRINT_DEBUG:
+                print("Using RAM scratch for {} ({} MB)".format(name, needed // 2**20))
+            return ram_dir
+    if not reserve_scratch(TMP_storage, name, needed):
+        raise OSError("Not enough space in {} for {}: {} MB needed, {} MB free".format(
+            work_dir, name, (needed + SCRATCH_reserve) // 2**20,
+            shutil.disk_usage(work_dir).free // 2**20))
+    return work_dir
+
+
+async def prepare_repository_async(name, idict, work_dir):
+    """Provides an up-to-date repository to count in and returns the tuple of
+    its directory and the reference whose history should be counted.
+    Without `MIRROR_dir`, the repository is freshly cloned into `work_dir`.
+    With `MIRROR_dir`, the persistent mirror is fetched; it is used directly
+    with `no_checkout`, otherwise the clone in `work_dir` shares its objects.
+    The clone is placed in RAM if possible (see `select_work_dir`)."""
+    no_checkout = use_no_checkout(idict)
+    url = idict["url"]
+    if MIRROR_dir:
+        url = await update_mirror_async(name, idict)
+        if no_checkout:
+            # Branches of the original repository are local ones in the mirror
+            return url, idict.get("branch", "HEAD")
+        # The objects stay in the mirror, only the checkout is needed
+        checkout_bytes = await read_checkout_bytes_async(name, url, idict.get("branch", "HEAD"),
+                                                         idict)
+        estimate = estimate_scratch_bytes(idict, 0, checkout_bytes)
+    else:
+        index_entry = loc_storage.read_index(STORE_dir).get(name, {})
+        estimate = None
+        if "object_bytes" in index_entry:
+            estimate = estimate_scratch_bytes(idict, index_entry["object_bytes"],
+                                              index_entry["checkout_bytes"])
+    work_dir = select_work_dir(name, work_dir, estimate)
+    repo_dir = os.path.join(work_dir, name)
+    clone_cmd = [GIT_binary, "clone"]
+    sparse_cmd = None if no_checkout else get_sparse_checkout_cmd(idict)
+    if MIRROR_dir:
+        # Borrow all objects from the mirror instead of copying them
+        clone_cmd.append("--shared")
+    if sparse_cmd:
+        # Only check out the files at the root until the paths are set
+        clone_cmd.append("--sparse")
+    if no_checkout:
+        # Everything is read from the object database, no working tree needed
+        clone_cmd.append("--no-checkout")
+        if idict.get("blobless", USE_blobless):
+            clone_cmd.append("--filter=blob:none")
+    clone_cmd.extend([url, name])
+    if os.path.exists(repo_dir):
+        # Left behind by an interrupted run
+        shutil.rmtree(repo_dir, False)
+    await run_cmd_async(clone_cmd, False, cwd=work_dir, repo=name)
+    # --show-current only supported by git >= 2.22
+    # git_show_current_branch = [GIT_binary, "branch", "--show-current"]
+    git_show_current_branch = [GIT_binary, "symbolic-ref", "--short", "HEAD"]
+    branch_out = await run_cmd_async(git_show_current_branch, True, cwd=repo_dir, repo=name)
+    if len(branch_out.output) < 1:
+        shutil.rmtree(repo_dir, False) # remove directory recursively, throw on error
+        await run_cmd_async(clone_cmd, False, cwd=work_dir, repo=name)
+    if sparse_cmd:
+        await run_cmd_async(sparse_cmd, cwd=repo_dir, repo=name)
+
+    log_ref = "HEAD"
+    if no_checkout:
+        # The clone is fresh, so there is nothing to pull
+        if "branch" in idict:
+            log_ref = "origin/" + idict["branch"]
+    else:
+        await run_cmd_async([GIT_binary, "pull"], False, cwd=repo_dir, repo=name)
+
+        if "branch" in idict:
+            await run_cmd_async([GIT_binary, "checkout", idict["branch"]], cwd=repo_dir, repo=name)
+            await run_cmd_async([GIT_binary, "pull"], False, cwd=repo_dir, repo=name)
+    if not MIRROR_dir:
+        # Estimate the size of the next clone from this one; without a
+        # checkout, the blobs may be missing, so only the objects count
+        object_bytes = await read_object_bytes_async(name, repo_dir)
+        checkout_bytes = 0
+        if not no_checkout:
+            checkout_bytes = await read_checkout_bytes_async(name, repo_dir, log_ref, idict)
+        loc_storage.update_index(STORE_dir, name, {"object_bytes": object_bytes,
+                                                   "checkout_bytes": checkout_bytes})
+    return repo_dir, log_ref
+
+
+def prepare_repository(name, idict, work_dir):
+    """Blocking version of `prepare_repository_async`."""
+    return asyncio.run(prepare_repository_async(name, idict, work_dir))
+
+
+def process_repository(name, idict, work_dir, progress=None, prepared=None):
+    """Clones the repository `name` into `work_dir`, counts the LOC of the
+    selected commits and writes the result to `OUT_dir/<name>.csv`.
+    All commands are executed inside `work_dir`, so multiple repositories can
+    be processed concurrently as long as each one uses its own directory.
+    `progress` (ProgressReporter) is informed about the progress.
+    `prepared` is the result of `prepare_repository` if the repository was
+    already cloned or fetched."""
+    if "url" not in idict:
+        return
+    if progress and not prepared:
+        progress.set_state("preparing")
+    out_file = OUT_dir + "/" + name + ".csv"
+    # Rows counted so far; kept until the result file is complete
+    result_log = ResultLog(OUT_dir_tmp + "/" + name + ".log")
+    if not loc_storage.has_repository(STORE_dir, name) and os.path.exists(out_file):
+        # Result file of an older version without the store
+        if PRINT_DEBUG:
+            print("Importing existing cloc result file: {}".format(out_file))
+        loc_storage.import_csv(STORE_dir, name, out_file)
+    index_entry = loc_storage.read_index(STORE_dir).get(name, {})
+    newest_processed_timestamp = float("-inf")
+    existing_commits = set()
+    if index_entry.get("rows", 0) > 0:
+        newest_processed_timestamp = index_entry["newest_timestamp"]
+        if PRINT_DEBUG:
+            print("Latest processed commit at: {}".format(index_entry["newest_date"]))
+        existing_commits = set(commit.decode() for commit in
+                               loc_storage.load_column(STORE_dir, name, "commit"))
+    no_checkout = use_no_checkout(idict)
+    repo_dir = None
+    try:
+        repo_dir, log_ref = prepared or prepare_repository(name, idict, work_dir)
+        tip_out = run_cmd([GIT_binary, "rev-parse", "--verify", log_ref + "^{commit}"],
+                          cwd=repo_dir)
+        tip_commit = tip_out.output[0]
+        # Only the new history is needed, unless the sample budget is spread
+        # over the whole history
+        stop_timestamp = None
+        since_commit = None
+        if not idict.get("samples", NUM_samples) and newest_processed_timestamp > float("-inf"):
+            stop_timestamp = newest_processed_timestamp
+            last_tip = index_entry.get("tip_commit")
+            if USE_last_tip and last_tip:
+                is_ancestor = run_cmd([GIT_binary, "merge-base", "--is-ancestor", last_tip, tip_commit],
+                                      True, cwd=repo_dir)
+                if is_ancestor.ret_code == 0:
+                    since_commit = last_tip
+                elif PRINT_DEBUG:
+                    print("Last processed tip {} is not part of the history anymore"
+                          .format(last_tip))
+        if PRINT_DEBUG:
+            print("Repo: {}".format(name))
+            if not use_incremental(idict):
+                # Incremental counting never scans the whole checkout
+                begin = time.time()
+                loc, loc_sum = call_cloc(idict, repo_dir)
+                end = time.time()
+                print("Time: {} s\n".format(end-begin)
+                      +"loc = {} ({})".format(loc, loc_sum))
+
+        merges_only = not idict.get("all_commits")
+        history = read_history(repo_dir, log_ref, stop_timestamp, since_commit, merges_only)
+        candidates = history
+        if idict.get("samples", NUM_samples):
+            # The sample budget is spread over the whole history of the candidates
+            candidates = list(history)
+            if merges_only and len(candidates) < MIN_merge_commits:
+                # Too few merges to show the evolution, but the number of
+                # counted commits is bounded by the sample budget anyway
+                if PRINT_DEBUG:
+                    print("Only {} merge commits, sampling all commits instead"
+                          .format(len(candidates)))
+                candidates = list(read_history(repo_dir, log_ref, stop_timestamp, since_commit))
+        commits = [c for c in select_commits(idict, candidates, newest_processed_timestamp)
+                   if c[1] not in existing_commits]
+        # Stops git log if the selection ended before the end of the history
+        history.close()
+        if PRINT_DEBUG:
+            print("num_commits: {}".format(len(commits)))
+        header = "Date{d}Commit Hash{d}LOC{d}Total LOC".format(d=OUT_delim)
+        print(header)
+
+        # Skip the commits counted by a previous, interrupted run
+        missing_commits = [c for c in commits if not result_log.done(c[1])]
+        if PRINT_DEBUG and len(missing_commits) < len(commits):
+            print("Resuming: {} of {} commits were already counted"
+                  .format(len(commits) - len(missing_commits), len(commits)))
+        if progress:
+            progress.start_counting(len(missing_commits))
+            def on_row(commit, row, lang_counts):
+                result_log.append(commit, row, lang_counts)
+                progress.commit_counted()
+        else:
+            on_row = result_log.append
+        num_shards = idict.get("shards", NUM_shards)
+        if num_shards > 1 and len(missing_commits) > 1:
+            count_commits_sharded(idict, repo_dir, missing_commits, num_shards, on_row)
+        else:
+            count_commits(idict, repo_dir, missing_commits, on_row)
+
+        # Add the new rows in front of the old, existing data
+        new_commits = [commit for _, commit in commits]
+        if new_commits or not loc_storage.has_repository(STORE_dir, name):
+            loc_storage.prepend_rows(STORE_dir, name,
+                                     [result_log.rows[commit].split(OUT_delim) for commit in new_commits],
+                                     [result_log.lang_counts[commit] for commit in new_commits],
+                                     get_counter_version(idict))
+        if new_commits or not os.path.exists(out_file):
+            loc_storage.export_csv(STORE_dir, name, out_file)
+        # Everything up to the tip is processed now
+        loc_storage.update_index(STORE_dir, name, {"tip_commit": tip_commit})
+        result_log.remove()
+    finally:
+        result_log.close()
+        # At the end, delete the git repository (but never the mirror), also
+        # if interrupted, so the next run can clone it again
+        if repo_dir and not (MIRROR_dir and no_checkout):
+            shutil.rmtree(repo_dir, True)
+        release_scratch(name)
+
+
+def run_repository(name, idict, work_dir, prepared=None, prepare_seconds=0.0):
+    """Runs `process_repository`, reporting its progress to the status files,
+    tracing its total time and profiling it into `PROFILE_dir` if set.
+    `prepare_seconds` is the time it took to prepare the repository if it was
+    `prepared` elsewhere; it is included in the recorded and traced total."""
+    global TRACE_repo
+    TRACE_repo = name
+    begin = time.time() - prepare_seconds
+    progress = ProgressReporter(name, begin if prepared else None)
+    profile = None
+    if PROFILE_dir:
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        process_repository(name, idict, work_dir, progress, prepared)
+        progress.set_state("done")
+        record_run(name, time.time() - begin, progress.total)
+    except BaseException:
+        progress.set_state("failed")
+        raise
+    finally:
+        if profile:
+            profile.disable()
+            profile.dump_stats(os.path.join(PROFILE_dir, name + ".prof"))
+        trace("repository", time.time() - begin)
+        TRACE_repo = None
+
+
+def load_repositories(path):
+    """Returns the repositories of the JSON config file `path` as a dictionary
+    name -> options, in the order of the file. Disabled entries are left
+    out."""
+    with open(path, 'r') as config_file:
+        repositories = json.load(config_file)
+    return {name: idict for name, idict in repositories.items()
+            if not idict.get("disabled", False)}
+
+
+def record_run(name, seconds, commits):
+    """Records the duration and the number of counted commits of the run of
+    repository `name` in the store index, so later runs can be scheduled."""
+    loc_storage.update_index(STORE_dir, name, {"last_run": {
+        "seconds": round(seconds, 1), "commits": commits, "finished": int(time.time())}})
+
+
+def schedule_repositories(repositories, num_workers, budget=None):
+    """Orders the (name, info dictionary) `repositories` longest expected
+    processing time first, so the big repositories do not end up as the tail
+    of the run. The expected time is the duration of the previous run;
+    repositories without one are expected to take as long as the longest
+    known one.
+    With a `budget` in seconds, the repositories processed the longest time
+    ago are assigned first to the least loaded of `num_workers` workers, and
+    the ones that would exceed the budget are deferred. A repository is
+    always assigned to an idle worker, so none is deferred forever.
+    Returns the list of scheduled (name, info dictionary) and the list of
+    deferred names."""
+    index = loc_storage.read_index(STORE_dir)
+    last_runs = {name: index.get(name, {}).get("last_run", {}) for name, _ in repositories}
+    known = [run["seconds"] for run in last_runs.values() if "seconds" in run]
+    default_cost = max(known) if known else 0.0
+    costs = {name: run.get("seconds", default_cost) for name, run in last_runs.items()}
+    scheduled = list(repositories)
+    deferred = []
+    if budget is not None:
+        loads = [0.0] * num_workers
+        scheduled = []
+        for name, idict in sorted(repositories, key=lambda e: last_runs[e[0]].get("finished", 0)):
+            worker = loads.index(min(loads))
+            if loads[worker] > 0 and loads[worker] + costs[name] > budget:
+                deferred.append(name)
+                continue
+            loads[worker] += costs[name]
+            scheduled.append((name, idict))
+    # Stable, so repositories with equal costs keep the order of the config
+    scheduled.sort(key=lambda e: -costs[e[0]])
+    return scheduled, deferred
+
+
+def past_deadline(name):
+    """Returns whether the time budget is used up, in which case repository
+    `name` is deferred to a later run instead of being started."""
+    if RUN_deadline is None or time.time() < RUN_deadline:
+        return False
+    print("Time budget used up, deferring {}".format(name))
+    ProgressReporter(name).set_state("deferred")
+    return True
+
+
+def print_trace_summary(path, since):
+    """Prints the time spent in every stage and the slowest stages of every
+    repository, from the events of `path` recorded after `since`."""
+    stages = {}
+    repos = {}
+    repo_commits = {}
+    with open(path, 'r') as trace_file:
+        for line in trace_file:
+            event = json.loads(line)
+            if event["time"] < since:
+                continue
+            entry = stages.setdefault(event["stage"], [0, 0.0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += event["seconds"]
+            entry[2] = max(entry[2], event["seconds"])
+            entry[3] += event.get("bytes", 0)
+            if event["repo"] is not None:
+                repo_stages = repos.setdefault(event["repo"], {})
+                repo_stages[event["stage"]] = repo_stages.get(event["stage"], 0.0) + event["seconds"]
+                if event["stage"] == "commit":
+                    repo_commits[event["repo"]] = repo_commits.get(event["repo"], 0) + 1
+    print("{:<20} {:>8} {:>11} {:>10} {:>10} {:>12}".format(
+        "Stage", "Calls", "Total [s]", "Mean [s]", "Max [s]", "Output [MB]"))
+    for stage, (calls, total, maximum, num_bytes) in sorted(stages.items(),
+                                                            key=lambda e: -e[1][1]):
+        print("{:<20} {:>8} {:>11.2f} {:>10.4f} {:>10.3f} {:>12.2f}".format(
+            stage, calls, total, total / calls, maximum, num_bytes / 1e6))
+    # "repository" and "commit" contain the other stages
+    print("\n{:<20} {:>11} {:>8}  {}".format("Repository", "Total [s]", "Commits",
+                                            "Slowest stages"))
+    for repo, repo_stages in sorted(repos.items(), key=lambda e: -e[1].get("repository", 0.0)):
+        slowest = sorted(((seconds, stage) for stage, seconds in repo_stages.items()
+                          if stage not in ("repository", "commit")), reverse=True)[:3]
+        print("{:<20} {:>11.2f} {:>8}  {}".format(
+            repo, repo_stages.get("repository", 0.0), repo_commits.get(repo, 0),
+            ", ".join("{} {:.1f} s".format(stage, seconds) for seconds, stage in slowest)))
+
+
+def process_repository_job(name_idict):
+    """Entry point of a pool worker. Every worker process uses its own scratch
+    directory below `TMP_storage`. Returns the repository name and whether it
+    was processed successfully (or deferred), so one failing repository does
+    not stop the remaining ones."""
+    name, idict = name_idict
+    if past_deadline(name):
+        return name, True
+    work_dir = os.path.join(TMP_storage, "worker_{}".format(os.getpid()))
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    try:
+        run_repository(name, idict, work_dir)
+    except Exception as e:
+        print("Processing {} failed: {!r}".format(name, e))
+        return name, False
+    return name, True
+
+
+def count_repository_job(job):
+    """Entry point of a counting worker of the pipelined orchestration: counts
+    the already prepared repository. Returns whether it succeeded."""
+    name, idict, prepared, prepare_seconds = job
+    try:
+        run_repository(name, idict, TMP_storage, prepared, prepare_seconds)
+    except Exception as e:
+        print("Processing {} failed: {!r}".format(name, e))
+        return False
+    return True
+
+
+async def process_all_async(repositories):
+    """Processes all (name, info dictionary) `repositories` in a pipeline:
+    up to `NUM_fetch_jobs` repositories are cloned or fetched concurrently
+    (network bound, asyncio subprocesses), while up to `NUM_jobs` prepared
+    repositories are counted in worker processes (CPU bound). At most
+    `NUM_prefetch` prepared repositories wait for a counting worker.
+    Repositories start in the given order. Returns the failed names."""
+    loop = asyncio.get_running_loop()
+    fetch_limit = asyncio.Semaphore(NUM_fetch_jobs)
+    count_limit = asyncio.Semaphore(NUM_jobs)
+    # Bounds the repositories on disk that are prepared or being counted
+    ahead_limit = asyncio.Semaphore(NUM_jobs + NUM_prefetch)
+    failed = []
+
+    async def process(name, idict, executor):
+        async with ahead_limit:
+            if past_deadline(name):
+                return
+            progress = ProgressReporter(name)
+            progress.set_state("preparing")
+            try:
+                async with fetch_limit:
+                    begin = time.time()
+                    prepared = await prepare_repository_async(name, idict, TMP_storage)
+                    prepare_seconds = time.time() - begin
+            except Exception as e:
+                print("Preparing {} failed: {!r}".format(name, e))
+                progress.set_state("failed")
+                shutil.rmtree(os.path.join(TMP_storage, name), True)
+                if RAM_scratch_root:
+                    shutil.rmtree(os.path.join(RAM_scratch_root, name), True)
+                release_scratch(name)
+                failed.append(name)
+                return
+            async with count_limit:
+                success = await loop.run_in_executor(executor, count_repository_job,
+                                                     (name, idict, prepared, prepare_seconds))
+            if not success:
+                failed.append(name)
+
+    # "fork" makes sure the workers see the globals set by `parse_args`
+    with ProcessPoolExecutor(NUM_jobs, mp_context=multiprocessing.get_context("fork")) as executor:
+        await asyncio.gather(*(process(name, idict, executor)
+                               for name, idict in repositories if "url" in idict))
+    return failed
+
+
+def print_help():
+    print("Usage: {} [options]\n".format(sys.argv[0])
+        + "Options and arguments:\n"
+        + "-h, --help:     Print this help\n"
+        + "--config PATH:  Read the repositories from the JSON file PATH\n"
+        + "                (default: {})\n".format(CONFIG_file)
+        + "--only NAMES:   Only process the comma separated repositories NAMES\n"
+        + "--time-budget MINUTES: Stop starting repositories after MINUTES and\n"
+        + "                defer the ones not expected to fit to a later run\n"
+        + "--ram-scratch PATH: Clone repositories into a new subdirectory of the\n"
+        + "                RAM-backed directory PATH (e.g. /dev/shm) if they fit\n"
+        + "--ram-budget MB: Use at most MB of the file system of --ram-scratch\n"
+        + "--jobs N:       Process N repositories in parallel (default: {})\n".format(NUM_jobs)
+        + "--prefetch N:   Clone or fetch up to N repositories ahead, while\n"
+        + "                others are counted (default: {}, off)\n".format(NUM_prefetch)
+        + "--fetch-jobs N: Clone or fetch N repositories concurrently with\n"
+        + "                --prefetch (default: {})\n".format(NUM_fetch_jobs)
+        + "--shards N:     Count the commits of each repository in N parallel\n"
+        + "                git worktrees (default: {})\n".format(NUM_shards)
+        + "--incremental:  Only count the files that changed between two\n"
+        + "                consecutive commits\n"
+        + "--no-checkout:  Count straight from the git object database without\n"
+        + "                checking out any commit (implies --incremental)\n"
+        + "--blobless:     Use blobless clones with --no-checkout\n"
+        + "--blob-cache:   Keep the line counts of every file in a persistent\n"
+        + "                cache (implies --incremental)\n"
+        + "--samples N:    Count at most N evenly spaced commits per repository\n"
+        + "--counter TOOL: Count lines with TOOL: cloc (default) or python, an\n"
+        + "                in-process counter following the rules of cloc\n"
+        + "                (implies --incremental)\n"
+        + "--mirror-dir PATH: Keep bare mirrors of all repositories in PATH and\n"
+        + "                only fetch new history on reruns\n"
+        + "--reference PATH: Borrow objects of new mirrors from the repository\n"
+        + "                in PATH\n"
+        + "--full-history: Walk the history back to the newest counted commit\n"
+        + "                instead of only reading the commits added since the\n"
+        + "                tip of the previous run\n"
+        + "--trace PATH:   Append the duration and output size of every command,\n"
+        + "                commit and repository as JSON lines to PATH and print\n"
+        + "                a summary at the end\n"
+        + "--profile DIR:  Profile every repository with cProfile into\n"
+        + "                DIR/<name>.prof\n"
+        + "--status PATH:  Write the progress and estimated remaining time of\n"
+        + "                all repositories to PATH (default: {})\n".format(STATUS_file)
+         )
+
+
+def parse_args(argv):
+    """Parses the command line options and overwrites the corresponding
+    globals. Exits with a help message on invalid input."""
+    global NUM_jobs, NUM_shards, USE_incremental, NO_checkout, USE_blobless, USE_blob_cache
+    global MIRROR_dir, REFERENCE_repo, COUNT_tool, NUM_samples, TRACE_file, PROFILE_dir
+    global STATUS_file, NUM_prefetch, NUM_fetch_jobs, USE_last_tip
+    global CONFIG_file, ONLY_repositories, TIME_budget, RAM_scratch_dir, RAM_scratch_budget
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "-h" or arg == "--help":
+            print_help()
+            exit(0)
+        elif arg == "--config" and i + 1 < len(argv):
+            CONFIG_file = os.path.abspath(argv[i + 1])
+            i += 1
+        elif arg == "--only" and i + 1 < len(argv):
+            ONLY_repositories = argv[i + 1].split(',')
+            i += 1
+        elif arg == "--time-budget" and i + 1 < len(argv) and argv[i + 1].isdigit():
+            TIME_budget = int(argv[i + 1]) * 60
+            i += 1
+        elif arg == "--ram-scratch" and i + 1 < len(argv):
+            RAM_scratch_dir = os.path.abspath(argv[i + 1])
+            i += 1
+        elif arg == "--ram-budget" and i + 1 < len(argv) and argv[i + 1].isdigit():
+            RAM_scratch_budget = int(argv[i + 1]) * 2**20
+            i += 1
+        elif arg == "--jobs" and i + 1 < len(argv) and argv[i + 1].isdigit():
+            NUM_jobs = max(1, int(argv[i + 1]))
+            i += 1
+        elif arg == "--prefetch" and i + 1 < len(argv) and argv[i + 1].isdigit():
+            NUM_prefetch = int(argv[i + 1])
+            i += 1
+        elif arg == "--fetch-jobs" and i + 1 < len(argv) and argv[i + 1].isdigit():
+            NUM_fetch_jobs = max(1, int(argv[i + 1]))
+            i += 1
+        elif arg == "--shards" and i + 1 < len(argv) and argv[i + 1].isdigit():
+            NUM_shards = max(1, int(argv[i + 1]))
+            i += 1
+        elif arg == "--incremental":
+            USE_incremental = True
+        elif arg == "--no-checkout":
+            NO_checkout = True
+        elif arg == "--blobless":
+            USE_blobless = True
+        elif arg == "--blob-cache":
+            USE_blob_cache = True
+        elif arg == "--samples" and i + 1 < len(argv) and argv[i + 1].isdigit():
+            NUM_samples = max(1, int(argv[i + 1]))
+            i += 1
+        elif arg == "--counter" and i + 1 < len(argv) and argv[i + 1] in ("cloc", "python"):
+            COUNT_tool = argv[i + 1]
+            i += 1
+        elif arg == "--mirror-dir" and i + 1 < len(argv):
+            MIRROR_dir = os.path.abspath(argv[i + 1])
+            i += 1
+        elif arg == "--reference" and i + 1 < len(argv):
+            REFERENCE_repo = os.path.abspath(argv[i + 1])
+            i += 1
+        elif arg == "--full-history":
+            USE_last_tip = False
+        elif arg == "--trace" and i + 1 < len(argv):
+            TRACE_file = os.path.abspath(argv[i + 1])
+            i += 1
+        elif arg == "--profile" and i + 1 < len(argv):
+            PROFILE_dir = os.path.abspath(argv[i + 1])
+            i += 1
+        elif arg == "--status" and i + 1 < len(argv):
+            STATUS_file = os.path.abspath(argv[i + 1])
+            i += 1
+        else:
+            print_help()
+            exit(1)
+        i += 1
+
 
 if __name__ == "__main__":
+    parse_args(sys.argv[1:])
+
     # Change to the directory where the script is placed
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
     if not os.path.exists(OUT_dir):
@@ -252,24 +1897,50 @@ if __name__ == "__main__":
     if not os.path.exists(OUT_dir_tmp):
         os.makedirs(OUT_dir_tmp)
     OUT_dir_tmp = os.path.abspath(OUT_dir_tmp)
+    STORE_dir = os.path.abspath(STORE_dir)
+    STATUS_file = os.path.abspath(STATUS_file)
 
     # Make sure the temporary folder exists
     if not os.path.exists(TMP_storage):
         os.makedirs(TMP_storage)
-    # Change to temporary directory
-    os.chdir(TMP_storage)
+    if RAM_scratch_dir and not os.path.exists(RAM_scratch_dir):
+        os.makedirs(RAM_scratch_dir)
+    if MIRROR_dir and not os.path.exists(MIRROR_dir):
+        os.makedirs(MIRROR_dir)
+    if PROFILE_dir and not os.path.exists(PROFILE_dir):
+        os.makedirs(PROFILE_dir)
+    git_repositories = load_repositories(CONFIG_file)
+    if ONLY_repositories is not None:
+        unknown = [name for name in ONLY_repositories if name not in git_repositories]
+        if unknown:
+            print("Unknown repositories: {}".format(", ".join(unknown)))
+            exit(1)
+        git_repositories = {name: git_repositories[name] for name in ONLY_repositories}
+    init_status(name for name, idict in git_repositories.items() if "url" in idict)
+    run_begin = time.time()
+    repositories, deferred = schedule_repositories(
+        [(name, idict) for name, idict in git_repositories.items() if "url" in idict],
+        NUM_jobs, TIME_budget)
+    for name in deferred:
+        ProgressReporter(name).set_state("deferred")
+    if deferred:
+        print("Deferred to a later run: {}".format(", ".join(deferred)))
+    if TIME_budget is not None:
+        RUN_deadline = run_begin + TIME_budget
 
-    try:
-        sp = run_cmd([CLOC_binary, "--version"])
-    except FileNotFoundError as e:
-        print("`{}` binary not found. ".format(CLOC_binary)
-              + "Please change the `CLOC_binary` "
-              + "variable to point to the correct binary of "
-              + "https://github.com/AlDanial/cloc")
-        exit(1)
+    # cloc is not needed if all repositories are counted in-process
+    if any(get_count_tool(idict) == "cloc" for _, idict in repositories):
+        try:
+            sp = run_cmd([CLOC_binary, "--version"])
+        except FileNotFoundError as e:
+            print("`{}` binary not found. ".format(CLOC_binary)
+                  + "Please change the `CLOC_binary` "
+                  + "variable to point to the correct binary of "
+                  + "https://github.com/AlDanial/cloc")
+            exit(1)
 
-    cloc_version = sp.output[0]
-    print("cloc version: {}".format(cloc_version))
+        CLOC_version = sp.output[0]
+        print("cloc version: {}".format(CLOC_version))
     
     try:
         sp = run_cmd([GIT_binary, "--version"])
@@ -282,110 +1953,32 @@ if __name__ == "__main__":
     git_version = sp.output[0].split(' ')[-1]
     print("git version: {}".format(git_version))
 
-    for name, idict in git_repositories.items():
-        
-        now = datetime.now()
-        date_suffix = now.strftime("_%Y%m%d_%H%M")
-        out_file_tmp = OUT_dir_tmp + "/" + name + date_suffix + ".csv"
-        out_file = OUT_dir + "/" + name + ".csv"
-        existing_cloc_data = []
-        newest_processed_commit_date = datetime.combine(datetime.min.date(), datetime.min.time(), timezone.utc)
-        if os.path.exists(out_file):
-            if PRINT_DEBUG:
-                print("Existing cloc result file found: {}".format(out_file))
-            with open(out_file, 'r') as input_file:
-                existing_cloc_data = input_file.readlines()[1:]
-                newest_processed_commit_date = datetime.fromisoformat(existing_cloc_data[0].split(LOG_delim)[0])
-                if PRINT_DEBUG:
-                    print("Latest processed commit at: {}".format(newest_processed_commit_date))
-        with open(out_file_tmp, "w") as output_file:
-            if "url" not in idict:
-                os.chdir(TMP_storage) # need to change dir since we skip the for
-                continue
-            run_cmd([GIT_binary, "clone", idict["url"], name], False)
-            os.chdir(name)
-            # --show-current only supported by git >= 2.22
-            # git_show_current_branch = [GIT_binary, "branch", "--show-current"]
-            git_show_current_branch = [GIT_binary, "symbolic-ref", "--short", "HEAD"]
-            branch_out = run_cmd(git_show_current_branch, True)
-            if len(branch_out.output) < 1:
-                os.chdir(TMP_storage)
-                shutil.rmtree(name, False) # remove directory recursively, throw on error
-                run_cmd([GIT_binary, "clone", idict["url"], name], False)
-                os.chdir(name)
-            
-            run_cmd([GIT_binary, "pull"], False)
-
-            if "branch" in idict:
-                run_cmd([GIT_binary, "checkout", idict["branch"]])
-                run_cmd([GIT_binary, "pull"], False)
-            log_list = []
-            log_out = run_cmd([GIT_binary, "log",
-                                 "--merges", # Only lists merge commits
-                                 "--first-parent", # Only lists merge commits into current branch
-                                 "--date=iso-strict",
-                                 "--pretty=format:%ad{d}%H{d}%s".format(d=LOG_delim),
-                              ])
-            all_log_out = run_cmd([GIT_binary, "log",
-                                  "--date=iso-strict",
-                                  "--pretty=format:%ad{d}%H{d}%s".format(d=LOG_delim),
-                                  ])
-            if PRINT_DEBUG:
-                begin = time.time()
-                loc, loc_sum = call_cloc(idict)
-                end = time.time()
-                #own_print(output_file,
-                print("Repo: {}\nTime: {} s\n".format(name, end-begin)
-                      +"loc = {} ({})\n".format(loc, loc_sum)
-                      +"num_commits: {}\ntotal_commits: {}"
-                           .format(len(log_out.output), len(all_log_out.output)))
-                print("Oldest commit: " + all_log_out.output[-1])
-
-            if "all_commits" in idict and idict["all_commits"]:
-                log_list = all_log_out.output
-            else:
-                log_list = log_out.output
-            if "day_interval" in idict:
-                # Sort, so time goes backwards linearly (imperfect sort because of the time zone)
-                log_list.sort(reverse=True) 
-            own_print(output_file, "Date{d}Commit Hash{d}LOC{d}Total LOC".format(d=OUT_delim))
-
-            #"""
-            last_date = ""
-            for line in log_list:
-                spl = line.split(LOG_delim)
-                date = spl[0]
-                commit = spl[1]
-                if newest_processed_commit_date >= datetime.fromisoformat(date):
-                    if PRINT_DEBUG:
-                        print("Reached older commit than processed previously. Finishing up...")
-                    # Reached a point that has already been processed
-                    break
-                if last_date:
-                    end_date = len("YYYY-MM-DD")
-                    # Note: we look at the commits current -> last
-                    prev_date = datetime.fromisoformat(last_date[:end_date])
-                    cur_date = datetime.fromisoformat(date[:end_date])
-                    difference = prev_date - cur_date
-                    if "day_interval" in idict and difference.days < idict["day_interval"]:
-                        #print("Skipping {}".format(line))
-                        continue
-                
-                last_date = date
-                
-
-                # check out specific commit and count locs
-                run_cmd([GIT_binary, "checkout", commit])
-                loc, loc_sum = call_cloc(idict)
-                own_print(output_file, "{}{d}{}{d}{}{d}{}".format(date, commit, loc, loc_sum,
-                                                                  d=OUT_delim))
-            # Fill the result file with the old, existing data
-            for line in existing_cloc_data:
-                output_file.write(line) # Newline already part of the line
-            #"""
-
-            # At the end, delete the git repository
-            os.chdir(TMP_storage)
-            shutil.rmtree(name, False) # remove directory recursively, throw on error
-        shutil.copyfile(out_file_tmp, out_file)
+    if RAM_scratch_dir:
+        # Never touch what others keep in the (shared) RAM directory
+        RAM_scratch_root = tempfile.mkdtemp(prefix="loc_count_", dir=RAM_scratch_dir)
+    try:
+        if NUM_prefetch > 0:
+            failed = asyncio.run(process_all_async(repositories))
+            if failed:
+                print("Failed repositories: {}".format(", ".join(failed)))
+        elif NUM_jobs == 1:
+            for name, idict in repositories:
+                if not past_deadline(name):
+                    run_repository(name, idict, TMP_storage)
+        else:
+            # "fork" makes sure the workers see the globals set by `parse_args`
+            # and the absolute output paths from above
+            ctx = multiprocessing.get_context("fork")
+            failed = []
+            with ctx.Pool(NUM_jobs) as pool:
+                for name, success in pool.imap_unordered(process_repository_job, repositories):
+                    if not success:
+                        failed.append(name)
+            if failed:
+                print("Failed repositories: {}".format(", ".join(failed)))
+    finally:
+        if RAM_scratch_root:
+            shutil.rmtree(RAM_scratch_root, True)
     shutil.rmtree(TMP_storage, False) # remove temporary directory recursively, throw on error
+    if TRACE_file and os.path.exists(TRACE_file):
+        print_trace_summary(TRACE_file, run_begin)
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Columnar storage of the counted data of every repository.
+
+Every repository gets its own directory `<store>/<name>/`, which contains
+one NumPy `.npy` file per column. Rows are ordered newest commit first (like
+the CSV files), so the columns can be loaded memory-mapped without parsing
+anything:
+- timestamp.npy:   author date in seconds since the epoch (UTC, int64)
+- utc_offset.npy:  time zone offset of the author date in seconds (int32)
+- commit.npy:      commit hashes (bytes, 40 characters)
+- loc.npy:         LOC of the filtered languages (int64)
+- loc_sum.npy:     LOC of all languages (int64)
+- languages.npy:   names of all languages that appear in the repository
+- lang_counts.npy: (commits x languages x 4) table of the files, blank,
+                   comment and code lines of every language and commit
+- has_langs.npy:   whether the per-language table of a commit is known
+                   (it is not for rows imported from old CSV files)
+
+The file `<store>/index.json` holds the metadata of all repositories:
+newest commit, its date and timestamp, the number of rows, the counting
+tool version and the tip of the history when it was last processed.
+
+Run this file with `--import` to import all CSV files of the results
+folder into the store, or with `--export` to write the CSV files from it.
+"""
+
+import os
+import sys
+import json
+import fcntl
+import shutil
+from datetime import datetime, timezone, timedelta
+import numpy as np
+
+
+# Indices into the last dimension of the per-language table
+FILES = 0
+BLANK = 1
+COMMENT = 2
+CODE = 3
+
+INDEX_file = "index.json"
+CSV_delim = ";"
+CSV_header = "Date{d}Commit Hash{d}LOC{d}Total LOC".format(d=CSV_delim)
+
+
+def write_file_atomic(path, lines):
+    """Writes the `lines` (each one ending with a newline) to `path`, so that
+    `path` either contains the old or the complete new content, even if the
+    process dies while writing."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as out:
+        out.writelines(lines)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def repo_path(store_dir, name):
+    return os.path.join(store_dir, name)
+
+
+def save_columns_(store_dir, name, columns):
+    """Writes all `columns` (dictionary column name -> array) of repository
+    `name` into a new directory, which then replaces the old one, so readers
+    never see a mix of old and new columns."""
+    path = repo_path(store_dir, name)
+    new_path = path + ".new"
+    old_path = path + ".old"
+    shutil.rmtree(new_path, True)
+    os.makedirs(new_path)
+    for column, array in columns.items():
+        np.save(os.path.join(new_path, column + ".npy"), array)
+    if os.path.exists(path):
+        shutil.rmtree(old_path, True)
+        os.rename(path, old_path)
+    os.rename(new_path, path)
+    shutil.rmtree(old_path, True)
+
+
+def has_repository(store_dir, name):
+    path = repo_path(store_dir, name)
+    return os.path.exists(path) or os.path.exists(path + ".old")
+
+
+def load_column(store_dir, name, column, mmap=True):
+    """Returns the column `column` of repository `name`, memory-mapped if
+    `mmap` is True, or None if it does not exist."""
+    path = repo_path(store_dir, name)
+    if not os.path.exists(path) and os.path.exists(path + ".old"):
+        # Interrupted while replacing the columns
+        path = path + ".old"
+    file_name = os.path.join(path, column + ".npy")
+    if not os.path.exists(file_name):
+        return None
+    array = np.load(file_name, mmap_mode="r" if mmap else None)
+    if mmap and array.size == 0:
+        # Empty files cannot be mapped, numpy returns a regular array
+        return np.asarray(array)
+    return array
+
+
+def load_repository(store_dir, name, mmap=True):
+    """Returns all columns of repository `name` as a dictionary column name
+    -> array (memory-mapped if `mmap` is True), or None if it is not in the
+    store."""
+    if not has_repository(store_dir, name):
+        return None
+    columns = {}
+    for column in ("timestamp", "utc_offset", "commit", "loc", "loc_sum",
+                   "languages", "lang_counts", "has_langs"):
+        columns[column] = load_column(store_dir, name, column, mmap)
+        if columns[column] is None:
+            return None
+    return columns
+
+
+def empty_columns_():
+    return {
+        "timestamp": np.empty(0, dtype=np.int64),
+        "utc_offset": np.empty(0, dtype=np.int32),
+        "commit": np.empty(0, dtype="S40"),
+        "loc": np.empty(0, dtype=np.int64),
+        "loc_sum": np.empty(0, dtype=np.int64),
+        "languages": np.empty(0, dtype=str),
+        "lang_counts": np.zeros((0, 0, 4), dtype=np.int64),
+        "has_langs": np.empty(0, dtype=bool),
+        }
+
+
+def parse_date(date):
+    """Returns the tuple (timestamp, utc_offset in seconds) of an ISO date."""
+    parsed = datetime.fromisoformat(date)
+    return int(parsed.timestamp()), int(parsed.utcoffset().total_seconds())
+
+
+def format_date(timestamp, utc_offset):
+    """Inverse of `parse_date`: returns the ISO date (as printed by git)."""
+    zone = timezone(timedelta(seconds=int(utc_offset)))
+    return datetime.fromtimestamp(int(timestamp), zone).isoformat()
+
+
+def prepend_rows(store_dir, name, rows, lang_counts, version=""):
+    """Adds the new `rows` (newest first, all newer than the stored ones) in
+    front of the stored ones and updates the index. Every row is a tuple of
+    (date, commit, loc, loc_sum); `lang_counts` contains one dictionary
+    language -> (files, blank, comment, code) per row, or None if unknown.
+    `version` is the version of the counting tool."""
+    stored = load_repository(store_dir, name, mmap=False)
+    if stored is None:
+        stored = empty_columns_()
+    old_languages = list(stored["languages"])
+    # Add the new languages at the end, so the old indices stay valid
+    languages = list(old_languages)
+    for counts in lang_counts:
+        for lang in (counts or {}):
+            if lang not in languages:
+                languages.append(lang)
+    lang_idx = {lang: i for i, lang in enumerate(languages)}
+
+    num_new = len(rows)
+    num_old = len(stored["commit"])
+    table = np.zeros((num_new + num_old, len(languages), 4), dtype=np.int64)
+    for row, counts in enumerate(lang_counts):
+        for lang, values in (counts or {}).items():
+            table[row, lang_idx[lang]] = values
+    table[num_new:, :len(old_languages)] = stored["lang_counts"]
+    dates = [parse_date(row[0]) for row in rows]
+
+    columns = {
+        "timestamp": np.concatenate([np.array([d[0] for d in dates], dtype=np.int64),
+                                     stored["timestamp"]]),
+        "utc_offset": np.concatenate([np.array([d[1] for d in dates], dtype=np.int32),
+                                      stored["utc_offset"]]),
+        "commit": np.concatenate([np.array([row[1] for row in rows], dtype="S40"),
+                                  stored["commit"]]),
+        "loc": np.concatenate([np.array([int(row[2]) for row in rows], dtype=np.int64),
+                               stored["loc"]]),
+        "loc_sum": np.concatenate([np.array([int(row[3]) for row in rows], dtype=np.int64),
+                                   stored["loc_sum"]]),
+        "languages": np.array(languages, dtype=str),
+        "lang_counts": table,
+        "has_langs": np.concatenate([np.array([c is not None for c in lang_counts], dtype=bool),
+                                     stored["has_langs"]]),
+        }
+    save_columns_(store_dir, name, columns)
+
+    entry = {"rows": len(columns["commit"]), "version": version}
+    if entry["rows"] > 0:
+        entry["newest_commit"] = columns["commit"][0].decode()
+        entry["newest_timestamp"] = int(columns["timestamp"][0])
+        entry["newest_date"] = format_date(columns["timestamp"][0], columns["utc_offset"][0])
+    update_index(store_dir, name, entry)
+
+
+def read_index(store_dir):
+    """Returns the index: a dictionary repository name -> metadata."""
+    path = os.path.join(store_dir, INDEX_file)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as index_file:
+        return json.load(index_file)
+
+
+def update_index(store_dir, name, entry):
+    """Updates the index entry of repository `name` with the fields of the
+    dictionary `entry`. Multiple processes may update the index at the same
+    time."""
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, INDEX_file)
+    with open(path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        index = read_index(store_dir)
+        index[name] = dict(index.get(name, {}), **entry)
+        write_file_atomic(path, [json.dumps(index, indent=4, sort_keys=True) + '\n'])
+
+
+def import_csv(store_dir, name, csv_path):
+    """Imports the CSV result file `csv_path` (newest first) of repository
+    `name`, replacing what is stored for it. The per-language tables of the
+    imported rows are unknown."""
+    with open(csv_path, 'r') as input_file:
+        rows = [line.rstrip('\n').split(CSV_delim) for line in input_file.readlines()[1:]]
+    rows = [row for row in rows if len(row) >= 4]
+    # Keep the per-language tables of a store without the other columns
+    lang_counts = [None] * len(rows)
+    commits = load_column(store_dir, name, "commit", mmap=False)
+    languages = load_column(store_dir, name, "languages", mmap=False)
+    table = load_column(store_dir, name, "lang_counts", mmap=False)
+    if commits is not None and languages is not None and table is not None:
+        known = {commit.decode(): i for i, commit in enumerate(commits)}
+        for row_idx, row in enumerate(rows):
+            i = known.get(row[1])
+            if i is not None:
+                lang_counts[row_idx] = {lang: tuple(int(v) for v in table[i, j])
+                                        for j, lang in enumerate(languages)
+                                        if table[i, j].any()}
+    shutil.rmtree(repo_path(store_dir, name), True)
+    prepend_rows(store_dir, name, rows, lang_counts)
+
+
+def export_csv(store_dir, name, csv_path):
+    """Writes all rows of repository `name` as CSV result file `csv_path`."""
+    columns = load_repository(store_dir, name)
+    lines = [CSV_header + '\n']
+    for timestamp, utc_offset, commit, loc, loc_sum in zip(
+            columns["timestamp"], columns["utc_offset"], columns["commit"],
+            columns["loc"], columns["loc_sum"]):
+        lines.append("{}{d}{}{d}{}{d}{}\n".format(format_date(timestamp, utc_offset),
+                                                 commit.decode(), loc, loc_sum, d=CSV_delim))
+    write_file_atomic(csv_path, lines)
+
+
+def code_of_languages(languages, lang_counts, selected):
+    """Returns the code lines of every commit, only adding up the languages
+    in `selected` (all languages if it is None)."""
+    if selected is None:
+        return lang_counts[:, :, CODE].sum(axis=1)
+    mask = np.isin(languages, list(selected))
+    return lang_counts[:, mask, CODE].sum(axis=1)
+
+
+def print_help():
+    print("Usage: {} [option]\n".format(sys.argv[0])
+        + "Options and arguments:\n"
+        + "-h, --help: Print this help\n"
+        + "--import:   Import all CSV files of the results folder into the store\n"
+        + "--export:   Write the CSV files of all repositories in the store"
+         )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in ("--import", "--export"):
+        print_help()
+        exit(0 if len(sys.argv) == 2 and sys.argv[1] in ("-h", "--help") else 1)
+
+    # Change to the directory where the script is placed
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    results_dir = "./results"
+    store_dir = "./results/store"
+    if sys.argv[1] == "--import":
+        for el in sorted(os.listdir(results_dir)):
+            if el.endswith(".csv"):
+                print("Importing {}".format(el))
+                import_csv(store_dir, el[:-len(".csv")], os.path.join(results_dir, el))
+    else:
+        for name in sorted(read_index(store_dir)):
+            if not has_repository(store_dir, name):
+                # Only metadata, e.g. a repository whose first run failed
+                continue
+            print("Exporting {}".format(name))
+            export_csv(store_dir, name, os.path.join(results_dir, name + ".csv"))
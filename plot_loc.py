@@ -5,12 +5,20 @@ import sys
 import csv
 from datetime import datetime
 import math
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+import matplotlib
+matplotlib.use("Agg") # Only render to files, also in worker processes
 #import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_pdf import PdfPages
 import matplotlib.dates as mdates
 import matplotlib.ticker as mticker
 
+import loc_storage
+
 
 # Check out https://github.com/bokeh/bokeh/pull/4868/files to see if toggling on/off is possible
 
@@ -18,7 +26,18 @@ import matplotlib.ticker as mticker
 # let python run in background and enable / disable lines with user input
 
 DATA_folder = "./results/"
+STORE_folder = "./results/store/"
 PLOT_folder = "./plots/"
+# Output folder of `--batch`, and the file remembering the input of every
+# figure exported there, so unchanged figures are skipped
+BATCH_prefix = "batch/"
+BATCH_folder = PLOT_folder + BATCH_prefix
+BATCH_stamp_file = BATCH_folder + "stamps.json"
+
+# Formats every figure is exported as (any of "pdf", "svg", "png")
+PLOT_formats = ["pdf", "svg", "png"]
+# Number of processes rendering figures in parallel with `--batch`
+NUM_jobs = os.cpu_count() or 1
 
 CSV_delim = ';'
 
@@ -34,30 +53,82 @@ AxisYScale = 'log' # 'linear'
 AxisYScale = 'linear'
 AxisXScale = 'linear' # 'log'  Better don't touch since x-axis is Time here
 
+# Only commits authored on or after this date (in their own time zone) are
+# plotted; None plots all commits
+DATE_cutoff = "2017-01-01"
+
 
-def date_filter(date_):
-    return date_.year >= 2017
+def date_filter(x_date, utc_offset):
+    """Returns the boolean mask of the dates `x_date` (datetime64, UTC) that
+    pass the `DATE_cutoff`. `utc_offset` are their time zone offsets in
+    seconds."""
+    if DATE_cutoff is None:
+        return np.ones(len(x_date), dtype=bool)
+    local_date = x_date + utc_offset.astype("timedelta64[s]")
+    return local_date >= np.datetime64(DATE_cutoff, "s")
 
 
-def filter_xy(x, y):
+def filter_xy(x, y, utc_offset):
     if len(x) != len(y):
         raise AttributeError
-    new_x = []
-    new_y = []
-    for i in range(len(x)):
-        if date_filter(x[i]):
-            new_x.append(x[i])
-            new_y.append(y[i])
-    return new_x, new_y
-    
+    mask = date_filter(x, utc_offset)
+    return x[mask], y[mask]
+
+
+# Maximum number of points drawn per figure (shared evenly by all lines), so
+# dense series do not bloat the vector output; None draws every point
+PLOT_max_points = None
+
+
+def downsample_lttb(x, y, num_points):
+    """Returns the indices of at most `num_points` points of the series
+    (`x`, `y`), `x` sorted (ascending or descending), that keep its visual
+    shape. Uses Largest-Triangle-Three-Buckets: the first and last points
+    are kept, the others are split into equally sized buckets, and from
+    every bucket the point forming the largest triangle with the point
+    chosen from the previous bucket and the mean of the next bucket is
+    kept. Peaks and drops therefore survive. With less than 3 points, only
+    the last and first point are kept."""
+    n = len(x)
+    if num_points >= n:
+        return np.arange(n)
+    if num_points < 3:
+        return np.array([0, n - 1][2 - max(0, num_points):], dtype=np.int64)
+    x = x.astype(np.float64)
+    y = y.astype(np.float64)
+    # Bucket boundaries of the points between the first and last one
+    bounds = np.linspace(1, n - 1, num_points - 1).astype(np.int64)
+    indices = np.empty(num_points, dtype=np.int64)
+    indices[0] = 0
+    indices[-1] = n - 1
+    prev = 0
+    for b in range(num_points - 2):
+        begin, end = bounds[b], bounds[b + 1]
+        next_begin, next_end = end, bounds[b + 2] if b + 2 < len(bounds) else n
+        next_x = x[next_begin:next_end].mean()
+        next_y = y[next_begin:next_end].mean()
+        area = np.abs((x[prev] - next_x) * (y[begin:end] - y[prev])
+                      - (x[prev] - x[begin:end]) * (next_y - y[prev]))
+        prev = begin + int(np.argmax(area))
+        indices[b + 1] = prev
+    return indices
+
 
 
 ### dictionary to match purpose to CSV header
 h_dict = {
         "date" : "Date",
+        "commit": "Commit Hash",
         "loc": "LOC",
         }
 
+# Series are read from the columnar store (see loc_storage.py) if it contains
+# the repository, otherwise from its CSV file.
+# If set, the LOC are recomputed from the stored per-language tables and only
+# count these languages, e.g. ["C++", "CUDA"].
+# Only commits counted with the per-language tables are plotted then.
+plot_langs = None
+
 plot_set = set([
         #"deal.II",
         #"Eigen",
@@ -100,6 +171,17 @@ name_label_translate = {
         "ExampleName": "ExampleLabelName",
     }
 
+# Groups of repositories that get a combined figure with `--batch`, in
+# addition to the figure of every single repository
+plot_groups = {
+        "Algebra": ["LAPACK", "OpenBLAS", "ScaLAPACK", "DBCSR", "Eigen", "Armadillo", "Elemental"],
+        "Graphs": ["OGDF", "GraphChi", "Ligra", "KaHIP", "KaHyPar", "KaMIS", "NetworKit"],
+        "Bio": ["SeqAN", "genesis", "Treerecs", "RAxML-ng"],
+        "Solving": ["CVC4", "MiniSAT", "Z3"],
+        "Numerics": ["Ginkgo", "deal.II", "MFEM", "hypre", "petsc", "Trilinos", "SuperLU",
+                     "SuiteSparse", "Kokkos", "Kokkos Kernels", "MAGMA", "Slate"],
+    }
+
 def read_csv(path):
     """
     Opens the CSV file in 'path' and returns 2 values:
@@ -131,6 +213,48 @@ def read_csv(path):
     return data, i_dict
 
 
+def parse_utc_offset(suffix):
+    """Returns the time zone offset in seconds of an ISO date suffix, e.g.
+    "+02:00" or "Z"."""
+    if suffix in ("", "Z"):
+        return 0
+    sign = -1 if suffix[0] == '-' else 1
+    return sign * (int(suffix[1:3]) * 3600 + int(suffix[-2:]) * 60)
+
+
+def read_csv_series(path):
+    """Returns the tuple (dates, UTC offsets, LOC) of the CSV file `path` as
+    NumPy arrays. The dates are datetime64 in UTC."""
+    data, i_dict = read_csv(path)
+    dates = np.array([row[i_dict["date"]] for row in data], dtype=str)
+    loc = np.array([row[i_dict["loc"]] for row in data], dtype=np.int64)
+    # The first 19 characters are the local date and time, the rest is the
+    # time zone; there are only a few distinct time zones to parse
+    local_date = dates.astype("U19").astype("datetime64[s]")
+    suffixes, inverse = np.unique([date[19:] for date in dates], return_inverse=True)
+    utc_offset = np.array([parse_utc_offset(suffix) for suffix in suffixes],
+                          dtype=np.int64)[inverse.reshape(-1)]
+    return local_date - utc_offset.astype("timedelta64[s]"), utc_offset, loc
+
+
+def read_store(name, langs):
+    """Returns the tuple (dates, UTC offsets, LOC) of the repository `name`
+    from the memory-mapped columnar store (see loc_storage.py), or None if it
+    is not stored. The dates are datetime64 in UTC. If `langs` is not None,
+    the LOC are recomputed from the per-language tables and only count these
+    languages."""
+    columns = loc_storage.load_repository(STORE_folder, name)
+    if columns is None:
+        return None
+    x_date = columns["timestamp"].view("datetime64[s]")
+    utc_offset = columns["utc_offset"]
+    if langs is None:
+        return x_date, utc_offset, columns["loc"]
+    mask = columns["has_langs"]
+    loc = loc_storage.code_of_languages(columns["languages"], columns["lang_counts"][mask], langs)
+    return x_date[mask], utc_offset[mask], loc
+
+
 ############################### Actual Plotting ###############################
 ### Color definition
 myblue    = (0, 0.4470, 0.7410);
@@ -172,37 +296,223 @@ def plot_figure(fig, file_name, plot_prefix = ""):
     p_bbox = "tight"
     p_pad = 0
     p_dpi = 300  # Only useful for non-scalable formats
-    with PdfPages(file_path+".pdf") as export_pdf:
-        export_pdf.savefig(fig, dpi=p_dpi, bbox_inches=p_bbox, pad_inches=p_pad)
-    fig.savefig(file_path+".svg", dpi=p_dpi, bbox_inches=p_bbox, pad_inches=p_pad, format="svg")
-    fig.savefig(file_path+".png", dpi=p_dpi, bbox_inches=p_bbox, pad_inches=p_pad, format="png")
+    if "pdf" in PLOT_formats:
+        with PdfPages(file_path+".pdf") as export_pdf:
+            export_pdf.savefig(fig, dpi=p_dpi, bbox_inches=p_bbox, pad_inches=p_pad)
+    if "svg" in PLOT_formats:
+        fig.savefig(file_path+".svg", dpi=p_dpi, bbox_inches=p_bbox, pad_inches=p_pad, format="svg")
+    if "png" in PLOT_formats:
+        fig.savefig(file_path+".png", dpi=p_dpi, bbox_inches=p_bbox, pad_inches=p_pad, format="png")
+
+
+def read_series(name):
+    """Returns the filtered tuple (dates, LOC) of the repository `name`, or
+    None if there is no data for it."""
+    series = read_store(name, plot_langs)
+    if series is None:
+        csv_file = os.path.abspath(DATA_folder + name + ".csv")
+        if plot_langs is not None or not os.path.exists(csv_file):
+            # The per-language tables only exist in the store
+            return None
+        series = read_csv_series(csv_file)
+    x_date, utc_offset, y_loc = series
+    return filter_xy(x_date, y_loc, utc_offset)
+
+
+def render_figure(names, file_name, plot_prefix = ""):
+    """Plots the LOC evolution of all repositories in `names` into one
+    figure and exports it (see `plot_figure`)."""
+    fig, ax = create_fig_ax()
+
+    plot_lines = []
+    plot_series = []
+
+    for name in names:
+        series = read_series(name)
+        if series is None:
+            continue
+        plot_series.append((name_label_translate.get(name, name),) + series)
+
+    # Every series keeps at least its first, last and one point in between
+    series_points = None
+    if PLOT_max_points is not None and plot_series:
+        series_points = max(3, PLOT_max_points // len(plot_series))
+        if series_points * len(plot_series) > PLOT_max_points:
+            print("Warning: {} points are too few for {} series, using {} per series"
+                  .format(PLOT_max_points, len(plot_series), series_points))
+    for plot_name, x_date, y_loc in plot_series:
+        if series_points is not None:
+            keep = downsample_lttb(x_date, y_loc, series_points)
+            x_date, y_loc = x_date[keep], y_loc[keep]
+        plot_lines.append(ax.plot(x_date, y_loc,
+                                  marker='',
+                                  linewidth=PlotLineWidth,
+                                  drawstyle=DrawStyle,
+                                  #color=myblue,
+                                  label=plot_name))
+
+    # Format dates properly. For details:
+    # https://matplotlib.org/stable/gallery/ticks_and_spines/date_concise_formatter.html
+    locator = mdates.AutoDateLocator(minticks=3)
+    formatter = mdates.ConciseDateFormatter(locator)
+    #formatter.formats = ['%Y', '%b', '%d', '%H:%M', '%H:%M', '%S.%f']
+    #formatter.zero_formats = ['', '%Y', '%b', '%d-%b', '%H:%M', '%H:%M']
+    #formatter.offset_formats = ['', '%Y', '%Y-%b', '%Y-%b-%d', '%Y-%b-%d', '%Y-%b-%d %H:%M']
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(formatter)
+
+    ax.yaxis.set_major_formatter(mticker.FuncFormatter(lambda x, p: format(int(x), ',')))
+
+    ax.tick_params(axis='x', labelsize=AxisTickSize)
+    ax.tick_params(axis='y', labelsize=AxisTickSize)
+
+    ax.set_xlabel("Time", fontsize=LabelFontSize)
+    ax.set_ylabel("Lines of code", fontsize=LabelFontSize)
+
+    ax.legend(loc="upper left", ncol=max(1, math.ceil(len(plot_lines) / 20)), fontsize=LabelFontSize)
+
+    #plt.ion()
+    #plt.show()
+    plot_figure(fig, file_name, plot_prefix)
+
+
+def input_stamp(names):
+    """Returns a hash of everything the figure of the repositories `names`
+    depends on: their result files and the plotting settings."""
+    inputs = [DATE_cutoff, PLOT_max_points, plot_langs, FigSize, DrawStyle,
+              AxisYScale, [name_label_translate.get(name, name) for name in names]]
+    for name in names:
+        for path in (DATA_folder + name + ".csv",
+                     os.path.join(STORE_folder, name, "lang_counts.npy")):
+            if os.path.exists(path):
+                stat = os.stat(path)
+                inputs.append([path, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+
+def render_job(job):
+    """Entry point of a batch worker. Returns the file name of the figure and
+    an error message (None on success)."""
+    file_name, names = job
+    try:
+        render_figure(names, file_name, BATCH_prefix)
+    except Exception as e:
+        return file_name, repr(e)
+    return file_name, None
+
+
+def render_batch(repo_names):
+    """Renders one figure per repository in `repo_names` and one per group of
+    `plot_groups` into `BATCH_folder`, in `NUM_jobs` parallel processes.
+    Figures whose input did not change since their last export are skipped."""
+    if not os.path.exists(BATCH_folder):
+        os.makedirs(BATCH_folder)
+    stamps = {}
+    if os.path.exists(BATCH_stamp_file):
+        with open(BATCH_stamp_file, 'r') as stamp_file:
+            stamps = json.load(stamp_file)
+
+    figures = [(name, [name]) for name in repo_names]
+    for group, names in sorted(plot_groups.items()):
+        names = [name for name in names if name in repo_names]
+        if names:
+            figures.append(("group_" + group, names))
+
+    jobs = []
+    new_stamps = {}
+    for file_name, names in figures:
+        new_stamps[file_name] = input_stamp(names)
+        exported = all(os.path.exists(BATCH_folder + file_name + '.' + fmt) for fmt in PLOT_formats)
+        if exported and stamps.get(file_name) == new_stamps[file_name]:
+            continue
+        jobs.append((file_name, names))
+    print("Rendering {} of {} figures ({} unchanged)"
+          .format(len(jobs), len(figures), len(figures) - len(jobs)))
+
+    failed = []
+    with multiprocessing.get_context("fork").Pool(min(NUM_jobs, max(1, len(jobs)))) as pool:
+        for file_name, error in pool.imap_unordered(render_job, jobs):
+            if error is None:
+                stamps[file_name] = new_stamps[file_name]
+            else:
+                print("Rendering {} failed: {}".format(file_name, error))
+                stamps.pop(file_name, None)
+                failed.append(file_name)
+    with open(BATCH_stamp_file, 'w') as stamp_file:
+        json.dump(stamps, stamp_file, indent=4, sort_keys=True)
+    return failed
 
 
 
 def print_help():
-    print("Usage: {} [option]\n".format(sys.argv[0])
+    print("Usage: {} [options]\n".format(sys.argv[0])
         + "Options and arguments:\n"
         + "-h:     Print this help\n"
         + "--help: Print this help\n"
         + "--list: Print the list of candidates for plotting\n"
         + "--all:  Prints all candidates\n"
+        + "--since DATE: Only plot commits from DATE (YYYY[-MM[-DD]]) on, or\n"
+        + "        all commits if DATE is 'all' (default: {})\n".format(DATE_cutoff)
+        + "--max-points N: Draw at most N points per figure, keeping the\n"
+        + "        shape of every line (default: all points)\n"
+        + "--formats F: Comma separated list of the exported formats out of\n"
+        + "        pdf, svg and png (default: {})\n".format(",".join(PLOT_formats))
+        + "--batch: Plot one figure per repository and per group of\n"
+        + "        repositories into {}, skipping unchanged ones\n".format(BATCH_folder)
+        + "--jobs N: Render N figures in parallel with --batch (default: {})\n".format(NUM_jobs)
         + "No argument means plot."
          )
 
-if __name__ == "__main__":
+
+def parse_args(argv):
+    """Parses the command line options and overwrites the corresponding
+    globals. Returns the tuple (print_list, print_all, batch). Exits with a
+    help message on invalid input."""
+    global DATE_cutoff, PLOT_max_points, PLOT_formats, NUM_jobs
     print_list = False
     print_all = False
-    if len(sys.argv) == 2 and (sys.argv[1] == "--help" or sys.argv[1] == "-h"):
-        print_help()
-        exit(0)
-    elif len(sys.argv) == 2 and sys.argv[1] == "--list":
-        print_list = True
-    elif len(sys.argv) == 2 and sys.argv[1] == "--all":
-        print_all = True
-    elif len(sys.argv) != 1:
-        print_help()
-        exit(1)
-    
+    batch = False
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "-h" or arg == "--help":
+            print_help()
+            exit(0)
+        elif arg == "--list":
+            print_list = True
+        elif arg == "--all":
+            print_all = True
+        elif arg == "--batch":
+            batch = True
+        elif arg == "--jobs" and i + 1 < len(argv) and argv[i + 1].isdigit():
+            NUM_jobs = max(1, int(argv[i + 1]))
+            i += 1
+        elif (arg == "--formats" and i + 1 < len(argv)
+              and set(argv[i + 1].split(',')) <= set(["pdf", "svg", "png"])):
+            PLOT_formats = argv[i + 1].split(',')
+            i += 1
+        elif arg == "--since" and i + 1 < len(argv):
+            DATE_cutoff = None if argv[i + 1] == "all" else argv[i + 1]
+            i += 1
+        elif arg == "--max-points" and i + 1 < len(argv) and argv[i + 1].isdigit():
+            PLOT_max_points = int(argv[i + 1])
+            i += 1
+        else:
+            print_help()
+            exit(1)
+        i += 1
+    if DATE_cutoff is not None:
+        try:
+            np.datetime64(DATE_cutoff, "s")
+        except ValueError:
+            print_help()
+            exit(1)
+    return print_list, print_all, batch
+
+
+if __name__ == "__main__":
+    print_list, print_all, batch = parse_args(sys.argv[1:])
+
     # Change to the directory where the script is placed
     os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
@@ -234,60 +544,13 @@ if __name__ == "__main__":
         print(indent + "])")
         exit(0)
 
-    fig, ax = create_fig_ax()
-
-    plot_lines = []
-    
-    for csv_file in csv_list:
-        name = csv_file[:-len(".csv")]
-        plot_name = name
-        if name in name_label_translate:
-            plot_name = name_label_translate[name]
+    repo_names = [csv_file[:-len(".csv")] for csv_file in csv_list]
+    if batch:
+        failed = render_batch(repo_names)
+        exit(1 if failed else 0)
 
-        if not print_all and name not in plot_set:
-            continue
-
-        input_csv = os.path.abspath(DATA_folder + csv_file)
-        data, i_dict = read_csv(input_csv)
-
-        x_date = []
-        y_loc = []
-        for row in data:
-            x_date.append(datetime.strptime(row[i_dict["date"]],
-                "%Y-%m-%dT%H:%M:%S%z"))
-            y_loc.append(int(row[i_dict["loc"]]))
-
-        x_date, y_loc = filter_xy(x_date, y_loc)
-        
-        plot_lines.append(ax.plot(x_date, y_loc,
-                                  marker='',
-                                  linewidth=PlotLineWidth,
-                                  drawstyle=DrawStyle,
-                                  #color=myblue,
-                                  label=plot_name))
-    
-    # Format dates properly. For details:
-    # https://matplotlib.org/stable/gallery/ticks_and_spines/date_concise_formatter.html
-    locator = mdates.AutoDateLocator(minticks=3)
-    formatter = mdates.ConciseDateFormatter(locator)
-    #formatter.formats = ['%Y', '%b', '%d', '%H:%M', '%H:%M', '%S.%f']
-    #formatter.zero_formats = ['', '%Y', '%b', '%d-%b', '%H:%M', '%H:%M']
-    #formatter.offset_formats = ['', '%Y', '%Y-%b', '%Y-%b-%d', '%Y-%b-%d', '%Y-%b-%d %H:%M']
-    ax.xaxis.set_major_locator(locator)
-    ax.xaxis.set_major_formatter(formatter)
-
-    ax.yaxis.set_major_formatter(mticker.FuncFormatter(lambda x, p: format(int(x), ',')))
-    
-    ax.tick_params(axis='x', labelsize=AxisTickSize)
-    ax.tick_params(axis='y', labelsize=AxisTickSize)
-    
-    ax.set_xlabel("Time", fontsize=LabelFontSize)
-    ax.set_ylabel("Lines of code", fontsize=LabelFontSize)
-    
-    ax.legend(loc="upper left", ncol=math.ceil(len(plot_lines) / 20), fontsize=LabelFontSize)
-
-    #plt.ion()
-    #plt.show()
+    if not print_all:
+        repo_names = [name for name in repo_names if name in plot_set]
     now = datetime.now()
     date_prefix = now.strftime("%Y%m%d_%H%M_")
-    plot_figure(fig, date_prefix + "LoC_evolution")
+    render_figure(repo_names, date_prefix + "LoC_evolution")
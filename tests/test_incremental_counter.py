@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import random
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import count_loc
+
+
+# Contents shared by several files, so copies and moves produce duplicate
+# blobs under names in different (or no) languages
+CONTENTS = [
+    "int a;\n\n// one\nint b;\n",
+    "/* two */\nvoid f() {\n    return;\n}\n",
+    "x = 1\n# three\n\ny = 2\n",
+]
+NAMES = ["notes.txt", "code.cpp", "code.c", "code.h", "script.py", "README"]
+DIRS = ["", "src/", "src/sub/", "lib/"]
+
+
+def git(repo_dir, *args):
+    return subprocess.run(["git"] + list(args), cwd=repo_dir, check=True,
+                          stdout=subprocess.PIPE).stdout.decode().strip()
+
+
+def make_history(repo_dir, num_commits, rng):
+    """Creates a repository with `num_commits` random commits that add, copy,
+    move, modify and remove files, and returns their hashes."""
+    git(repo_dir, "init", "-q")
+    git(repo_dir, "config", "user.name", "test")
+    git(repo_dir, "config", "user.email", "test@example.com")
+    files = {}
+    commits = []
+    for i in range(num_commits):
+        for _ in range(rng.randint(1, 4)):
+            action = rng.choice(["add", "copy", "move", "modify", "remove"])
+            path = rng.choice(DIRS) + rng.choice(NAMES)
+            if action == "add" or not files:
+                files[path] = rng.choice(CONTENTS)
+            elif action == "copy":
+                files[path] = files[rng.choice(sorted(files))]
+            elif action == "move":
+                source = rng.choice(sorted(files))
+                files[path] = files.pop(source)
+            elif action == "modify":
+                target = rng.choice(sorted(files))
+                files[target] = rng.choice(CONTENTS) + "int c{};\n".format(i)
+            else:
+                del files[rng.choice(sorted(files))]
+        for root, dirs, names in os.walk(repo_dir):
+            dirs[:] = [d for d in dirs if d != ".git"]
+            for name in names:
+                os.remove(os.path.join(root, name))
+        for path, content in files.items():
+            file_path = os.path.join(repo_dir, path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "w") as out_file:
+                out_file.write(content)
+        git(repo_dir, "add", "-A")
+        git(repo_dir, "commit", "-q", "--allow-empty", "-m", str(i))
+        commits.append(git(repo_dir, "rev-parse", "HEAD"))
+    return commits
+
+
+class IncrementalCounterTest(unittest.TestCase):
+    info_dict = {"counter": "python", "langs": "ALL"}
+
+    def setUp(self):
+        self.repo_dir = tempfile.mkdtemp(prefix="loc_test_")
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_dir, True)
+
+    def fresh_count(self, commit):
+        counter = count_loc.IncrementalCounter(self.info_dict, self.repo_dir, from_objects=True)
+        try:
+            return counter.count(commit), counter.language_counts()
+        finally:
+            counter.close()
+
+    def test_random_order_matches_fresh_count(self):
+        rng = random.Random(4)
+        commits = make_history(self.repo_dir, 30, rng)
+        expected = {commit: self.fresh_count(commit) for commit in commits}
+        for _ in range(5):
+            order = commits + rng.sample(commits, len(commits))
+            counter = count_loc.IncrementalCounter(self.info_dict, self.repo_dir,
+                                                   from_objects=True)
+            try:
+                for commit in order:
+                    result = (counter.count(commit), counter.language_counts())
+                    self.assertEqual(result, expected[commit])
+            finally:
+                counter.close()
+
+    def test_duplicate_of_unrecognized_file(self):
+        os.makedirs(self.repo_dir, exist_ok=True)
+        git(self.repo_dir, "init", "-q")
+        git(self.repo_dir, "config", "user.name", "test")
+        git(self.repo_dir, "config", "user.email", "test@example.com")
+        commits = []
+        for names in (["notes.txt"], ["notes.txt", "code.cpp"], ["code.cpp"]):
+            for name in os.listdir(self.repo_dir):
+                if name != ".git":
+                    os.remove(os.path.join(self.repo_dir, name))
+            for name in names:
+                with open(os.path.join(self.repo_dir, name), "w") as out_file:
+                    out_file.write(CONTENTS[0])
+            git(self.repo_dir, "add", "-A")
+            git(self.repo_dir, "commit", "-q", "-m", " ".join(names))
+            commits.append(git(self.repo_dir, "rev-parse", "HEAD"))
+        counter = count_loc.IncrementalCounter(self.info_dict, self.repo_dir, from_objects=True)
+        try:
+            for commit in commits + commits[::-1]:
+                self.assertEqual(counter.count(commit), self.fresh_count(commit)[0])
+        finally:
+            counter.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
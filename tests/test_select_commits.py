@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import count_loc
+
+
+def make_history(num_commits, rng):
+    """Returns random (timestamp, date, commit, commit timestamp) entries in
+    the order of git log: newest committer date first, every commit authored
+    at most a week before it was committed."""
+    history = []
+    committed = 10**9
+    for i in range(num_commits):
+        committed -= rng.randint(0, 3 * 24 * 60 * 60)
+        authored = committed - rng.choice([0, 0, rng.randint(0, 7 * 24 * 60 * 60)])
+        history.append((authored, "date{}".format(i), "commit{}".format(i), committed))
+    return history
+
+
+class SelectCommitsTest(unittest.TestCase):
+    def test_sort_by_author_date(self):
+        rng = random.Random(21)
+        for _ in range(20):
+            history = make_history(200, rng)
+            self.assertEqual(list(count_loc.sort_by_author_date(iter(history))),
+                             sorted(history, key=lambda e: e[0], reverse=True))
+
+    def test_day_interval(self):
+        rng = random.Random(7)
+        count_loc.PRINT_DEBUG = False
+        history = make_history(300, rng)
+        interval = 2 * 24 * 60 * 60
+        for processed in (float("-inf"), history[150][0]):
+            expected = []
+            next_target = None
+            for timestamp, date, commit, _ in sorted(history, key=lambda e: e[0], reverse=True):
+                if timestamp <= processed:
+                    break
+                if next_target is None or timestamp <= next_target:
+                    expected.append((date, commit))
+                    next_target = timestamp - interval
+            self.assertEqual(count_loc.select_commits({"day_interval": 2}, iter(history), processed),
+                             expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""
+Interactive viewer of the LOC evolution of all counted repositories.
+
+Starts a small local web server and opens a page listing every repository.
+The series of a repository is only loaded when it is toggled on, and the
+server downsamples it (see `plot_loc.downsample_lttb`) to the visible time
+range and the width of the chart, so zooming in reveals more detail while
+browsing all repositories stays responsive. Nothing is rendered to files.
+"""
+
+import os
+import sys
+import json
+import threading
+import webbrowser
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+import plot_loc
+
+
+HOST = "127.0.0.1"
+PORT = 8050
+# Number of repositories whose series are kept in memory
+SERIES_cache_size = 32
+# Show the whole history by default (see `plot_loc.DATE_cutoff`)
+plot_loc.DATE_cutoff = None
+
+
+class SeriesCache:
+    """Keeps the series (timestamps in seconds, LOC) of the most recently
+    requested repositories in memory."""
+    def __init__(self, size):
+        self.size = size
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            if name in self.series:
+                # Re-insert, so the dictionary stays ordered by last use
+                self.series[name] = self.series.pop(name)
+                return self.series[name]
+        series = plot_loc.read_series(name)
+        if series is not None:
+            x_date, y_loc = series
+            # Ascending time, as needed for the range lookups
+            order = np.argsort(x_date, kind="stable")
+            series = (x_date[order].astype(np.int64), np.asarray(y_loc)[order])
+        with self.lock:
+            self.series[name] = series
+            while len(self.series) > self.size:
+                del self.series[next(iter(self.series))]
+        return series
+
+
+def list_repositories():
+    """Returns the names of all repositories with results."""
+    names = set(name for name in plot_loc.loc_storage.read_index(plot_loc.STORE_folder)
+                if plot_loc.loc_storage.has_repository(plot_loc.STORE_folder, name))
+    for el in os.listdir(plot_loc.DATA_folder):
+        if el.endswith(".csv"):
+            names.add(el[:-len(".csv")])
+    return sorted(names, key=lambda e: e.upper())
+
+
+def select_range(series, begin, end, points):
+    """Returns the points of `series` between the timestamps `begin` and
+    `end` (None for unbounded), downsampled to at most `points` points. The
+    neighbors just outside of the range are kept, so lines reach the border
+    of the chart."""
+    x, y = series
+    first = 0 if begin is None else max(0, np.searchsorted(x, begin, "left") - 1)
+    last = len(x) if end is None else min(len(x), np.searchsorted(x, end, "right") + 1)
+    x, y = x[first:last], y[first:last]
+    keep = plot_loc.downsample_lttb(x, y, points)
+    return x[keep], y[keep]
+
+
+class ViewerHandler(BaseHTTPRequestHandler):
+    cache = SeriesCache(SERIES_cache_size)
+
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode(), "application/json", status)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == "/":
+            self.send_body(PAGE.encode(), "text/html; charset=utf-8")
+        elif url.path == "/repositories":
+            self.send_json([{"name": name, "label": plot_loc.name_label_translate.get(name, name)}
+                            for name in list_repositories()])
+        elif url.path == "/series":
+            try:
+                name = query["name"][0]
+                begin = int(query["begin"][0]) if "begin" in query else None
+                end = int(query["end"][0]) if "end" in query else None
+                points = max(3, min(20000, int(query.get("points", ["1000"])[0])))
+            except (KeyError, ValueError):
+                self.send_json({"error": "invalid query"}, 400)
+                return
+            # The name becomes part of file paths, only accept known ones
+            if name not in list_repositories():
+                self.send_json({"error": "unknown repository"}, 404)
+                return
+            series = self.cache.get(name)
+            if series is None:
+                self.send_json({"error": "unknown repository"}, 404)
+                return
+            x, y = select_range(series, begin, end, points)
+            self.send_json({"name": name, "total": len(series[0]),
+                            "x": x.tolist(), "y": y.tolist()})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def log_message(self, format, *args):
+        # Every zoom requests all shown series; do not flood the terminal
+        pass
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>LOC evolution</title>
+<style>
+  body { font-family: sans-serif; margin: 0; display: flex; height: 100vh; }
+  #repos { width: 230px; overflow-y: auto; border-right: 1px solid #ccc; padding: 8px; }
+  #repos label { display: block; white-space: nowrap; cursor: pointer; }
+  #main { flex: 1; display: flex; flex-direction: column; }
+  #chart { flex: 1; width: 100%; cursor: grab; }
+  #status { padding: 4px 8px; font-size: 12px; color: #555; }
+</style>
+</head>
+<body>
+<div id="repos"><input id="search" placeholder="Filter" style="width: 95%"></div>
+<div id="main">
+  <canvas id="chart"></canvas>
+  <div id="status">Toggle repositories on the left. Scroll to zoom, drag to pan, double click to reset.</div>
+</div>
+<script>
+const colors = ["#0072bd", "#d95319", "#edb120", "#7e2f8e", "#77ac30", "#4dbeee", "#a2142f",
+                "#404040", "#a62929"];
+const canvas = document.getElementById("chart");
+const ctx = canvas.getContext("2d");
+const shown = new Map();  // name -> {label, color, x, y}
+let view = null;          // [begin, end] in seconds, null: everything shown
+let nextColor = 0;
+let reloadTimer = null;
+
+function fetchSeries(name) {
+  const width = Math.max(100, Math.floor(canvas.width));
+  let url = "/series?name=" + encodeURIComponent(name) + "&points=" + width;
+  if (view) url += "&begin=" + Math.floor(view[0]) + "&end=" + Math.ceil(view[1]);
+  return fetch(url).then(r => r.json()).then(data => {
+    const entry = shown.get(name);
+    if (!entry || data.error) return;
+    entry.x = data.x;
+    entry.y = data.y;
+    entry.total = data.total;
+  });
+}
+
+function reloadAll() {
+  clearTimeout(reloadTimer);
+  reloadTimer = setTimeout(() => {
+    Promise.all([...shown.keys()].map(fetchSeries)).then(draw);
+  }, 150);
+}
+
+function dataRange() {
+  let x0 = Infinity, x1 = -Infinity;
+  for (const s of shown.values()) {
+    if (s.x && s.x.length) { x0 = Math.min(x0, s.x[0]); x1 = Math.max(x1, s.x[s.x.length - 1]); }
+  }
+  return x0 <= x1 ? [x0, x1 > x0 ? x1 : x0 + 86400] : [0, 86400];
+}
+
+function niceStep(range, count) {
+  const raw = range / count, mag = Math.pow(10, Math.floor(Math.log10(raw)));
+  for (const f of [1, 2, 5, 10]) if (f * mag >= raw) return f * mag;
+  return 10 * mag;
+}
+
+function draw() {
+  canvas.width = canvas.clientWidth;
+  canvas.height = canvas.clientHeight;
+  const pad = {l: 80, r: 20, t: 20, b: 40};
+  const w = canvas.width - pad.l - pad.r, h = canvas.height - pad.t - pad.b;
+  const [x0, x1] = view || dataRange();
+  let ymax = 1;
+  for (const s of shown.values()) {
+    if (!s.x) continue;
+    for (let i = 0; i < s.x.length; i++) if (s.x[i] >= x0 && s.x[i] <= x1) ymax = Math.max(ymax, s.y[i]);
+  }
+  const ystep = niceStep(ymax, 6);
+  ymax = Math.ceil(ymax / ystep) * ystep;
+  const px = x => pad.l + (x - x0) / (x1 - x0) * w;
+  const py = y => pad.t + h - y / ymax * h;
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+  ctx.font = "12px sans-serif";
+  ctx.strokeStyle = "#ddd";
+  ctx.fillStyle = "#333";
+  ctx.textAlign = "right";
+  for (let y = 0; y <= ymax; y += ystep) {
+    ctx.beginPath(); ctx.moveTo(pad.l, py(y)); ctx.lineTo(pad.l + w, py(y)); ctx.stroke();
+    ctx.fillText(y.toLocaleString(), pad.l - 6, py(y) + 4);
+  }
+  ctx.textAlign = "center";
+  const days = (x1 - x0) / 86400;
+  const monthStep = days > 3650 ? 24 : days > 1460 ? 12 : days > 365 ? 3 : 1;
+  const d = new Date(x0 * 1000);
+  let tick = new Date(Date.UTC(d.getUTCFullYear(), 0, 1));
+  while (tick.getTime() / 1000 <= x1) {
+    const t = tick.getTime() / 1000;
+    if (t >= x0) {
+      ctx.beginPath(); ctx.moveTo(px(t), pad.t); ctx.lineTo(px(t), pad.t + h); ctx.stroke();
+      const label = monthStep >= 12 ? String(tick.getUTCFullYear())
+                                    : tick.toISOString().slice(0, 7);
+      ctx.fillText(label, px(t), pad.t + h + 18);
+    }
+    tick = new Date(Date.UTC(tick.getUTCFullYear(), tick.getUTCMonth() + monthStep, 1));
+  }
+  ctx.save();
+  ctx.beginPath(); ctx.rect(pad.l, pad.t, w, h); ctx.clip();
+  ctx.lineWidth = 2;
+  for (const s of shown.values()) {
+    if (!s.x) continue;
+    ctx.strokeStyle = s.color;
+    ctx.beginPath();
+    for (let i = 0; i < s.x.length; i++) {
+      if (i === 0) ctx.moveTo(px(s.x[i]), py(s.y[i])); else ctx.lineTo(px(s.x[i]), py(s.y[i]));
+    }
+    ctx.stroke();
+  }
+  ctx.restore();
+  ctx.textAlign = "left";
+  let ly = pad.t + 14;
+  for (const s of shown.values()) {
+    ctx.fillStyle = s.color;
+    ctx.fillText(s.label + (s.x ? " (" + s.x.length + " of " + s.total + " points)" : ""),
+                 pad.l + 8, ly);
+    ly += 16;
+  }
+}
+
+function toggle(repo, checked, box) {
+  if (checked) {
+    const color = colors[nextColor++ % colors.length];
+    box.parentNode.style.color = color;
+    shown.set(repo.name, {label: repo.label, color: color});
+    fetchSeries(repo.name).then(draw);
+  } else {
+    box.parentNode.style.color = "";
+    shown.delete(repo.name);
+    draw();
+  }
+}
+
+fetch("/repositories").then(r => r.json()).then(repos => {
+  const list = document.getElementById("repos");
+  for (const repo of repos) {
+    const label = document.createElement("label");
+    const box = document.createElement("input");
+    box.type = "checkbox";
+    box.onchange = () => toggle(repo, box.checked, box);
+    label.appendChild(box);
+    label.appendChild(document.createTextNode(" " + repo.label));
+    list.appendChild(label);
+  }
+  document.getElementById("search").oninput = e => {
+    const text = e.target.value.toLowerCase();
+    for (const label of list.querySelectorAll("label"))
+      label.style.display = label.textContent.toLowerCase().includes(text) ? "" : "none";
+  };
+});
+
+canvas.addEventListener("wheel", e => {
+  e.preventDefault();
+  const [x0, x1] = view || dataRange();
+  const rect = canvas.getBoundingClientRect();
+  const frac = Math.min(1, Math.max(0, (e.clientX - rect.left - 80) / (rect.width - 100)));
+  const center = x0 + frac * (x1 - x0);
+  const scale = e.deltaY < 0 ? 0.8 : 1.25;
+  view = [center - (center - x0) * scale, center + (x1 - center) * scale];
+  draw();
+  reloadAll();
+}, {passive: false});
+
+let dragStart = null;
+canvas.addEventListener("mousedown", e => { dragStart = [e.clientX, view || dataRange()]; });
+window.addEventListener("mouseup", () => { if (dragStart) { dragStart = null; reloadAll(); } });
+canvas.addEventListener("mousemove", e => {
+  if (!dragStart) return;
+  const [startX, [x0, x1]] = dragStart;
+  const shift = (startX - e.clientX) / (canvas.width - 100) * (x1 - x0);
+  view = [x0 + shift, x1 + shift];
+  draw();
+});
+canvas.addEventListener("dblclick", () => { view = null; reloadAll(); });
+window.addEventListener("resize", () => { draw(); reloadAll(); });
+draw();
+</script>
+</body>
+</html>
+"""
+
+
+def print_help():
+    print("Usage: {} [options]\n".format(sys.argv[0])
+        + "Options and arguments:\n"
+        + "-h, --help:   Print this help\n"
+        + "--port N:     Serve the viewer on port N (default: {})\n".format(PORT)
+        + "--since DATE: Only show commits from DATE (YYYY[-MM[-DD]]) on\n"
+        + "--no-browser: Do not open the viewer in the web browser"
+         )
+
+
+def parse_args(argv):
+    """Parses the command line options and overwrites the corresponding
+    globals. Returns whether the browser should be opened. Exits with a help
+    message on invalid input."""
+    global PORT
+    open_browser = True
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        if arg == "-h" or arg == "--help":
+            print_help()
+            exit(0)
+        elif arg == "--port" and i + 1 < len(argv) and argv[i + 1].isdigit():
+            PORT = int(argv[i + 1])
+            i += 1
+        elif arg == "--since" and i + 1 < len(argv):
+            try:
+                np.datetime64(argv[i + 1], "s")
+            except ValueError:
+                print_help()
+                exit(1)
+            plot_loc.DATE_cutoff = argv[i + 1]
+            i += 1
+        elif arg == "--no-browser":
+            open_browser = False
+        else:
+            print_help()
+            exit(1)
+        i += 1
+    return open_browser
+
+
+if __name__ == "__main__":
+    open_browser = parse_args(sys.argv[1:])
+
+    # Change to the directory where the script is placed
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    server = ThreadingHTTPServer((HOST, PORT), ViewerHandler)
+    url = "http://{}:{}/".format(HOST, server.server_address[1])
+    print("Serving the viewer at {} (Ctrl+C to stop)".format(url))
+    if open_browser:
+        webbrowser.open(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()